@@ -0,0 +1,203 @@
+#
+#  NAME
+#    analysis.py
+#
+#  DESCRIPTION
+#    Spike-train analytics for many units at once: binned firing rates,
+#    peri-stimulus time histograms (PSTHs) against event times, and auto-
+#    and cross-correlograms within a lag window.  Spike times are kept
+#    sorted, so the spikes near each event (or each other spike) are found
+#    by binary search rather than by comparing every pair; those spikes are
+#    then expanded into (reference, spike) pairs a chunk at a time and all
+#    the units' histograms are filled by one bincount per chunk.  The work
+#    grows with the number of pairs inside the window, not with the square
+#    of the number of spikes.
+#
+#    Units can be given as one SpikeTrain (or array of spike times), a
+#    sequence of them, or a dict such as sorting.sort_spikes(...).units:
+#
+#        rates, edges = binned_rates(sorting.units, bin_size=.01)
+#        rates, edges = psth(sorting.units, stimulus_times, window=(-.5, 1.), bin_size=.01)
+#        counts, lags = correlograms(sorting.units, window=.05, bin_size=.001)
+#
+
+import numpy as np
+
+from spiketrain import SpikeTrain
+
+# (reference, spike) pairs expanded at once, to bound the temporaries
+PAIR_CHUNK = 1 << 22
+
+def unit_times(units):
+    """
+    Returns (times, single): the sorted spike times of each unit, as a list
+    of float64 arrays, and whether units was a single unit
+    """
+    if isinstance(units, (SpikeTrain, np.ndarray)):
+        units, single = [units], True
+    else:
+        units, single = (units.values() if isinstance(units, dict) else units), False
+    times = []
+    for unit in units:
+        unit = np.asarray(unit.times if isinstance(unit, SpikeTrain) else unit,
+                          dtype=np.float64).ravel()
+        if len(unit) > 1 and (np.diff(unit) < 0).any():
+            unit = np.sort(unit)
+        times.append(unit)
+    return times, single
+
+def merge_units(times):
+    """
+    Returns (merged, labels): the spike times of every unit in one sorted
+    array, and the unit number of each
+    """
+    merged = np.concatenate(times) if times else np.array([])
+    labels = np.repeat(np.arange(len(times)), [len(unit) for unit in times])
+    order = np.argsort(merged, kind='mergesort')
+    return merged[order], labels[order]
+
+def window_pairs(times, references, low, high, chunk=PAIR_CHUNK):
+    """
+    Yields (reference, spike, lag) arrays, a chunk of at most about chunk
+    pairs at a time, for every spike times[spike] whose lag
+    times[spike] - references[reference] has low <= lag < high.  times must
+    be sorted.
+    """
+    references = np.asarray(references, dtype=np.float64)
+    # searched a little wide, since references + low can round past a
+    # spike whose lag is low; the lag itself decides below
+    margin = (high - low) * 1e-6
+    first = np.searchsorted(times, references + (low - margin), 'left')
+    last = np.searchsorted(times, references + (high + margin), 'left')
+    counts = last - first
+    ends = np.cumsum(counts)
+    start = 0
+    while start < len(references):
+        # as many references as fit in chunk pairs, and at least one
+        stop = max(start + 1, np.searchsorted(ends, ends[start] - counts[start] + chunk, 'right'))
+        n = counts[start:stop]
+        total = n.sum()
+        if total:
+            reference = np.repeat(np.arange(start, stop), n)
+            # spike = first[reference] + its position among that reference's spikes
+            offsets = np.cumsum(n) - n
+            spike = np.arange(total) + np.repeat(first[start:stop] - offsets, n)
+            lag = times[spike] - references[reference]
+            inside = (lag >= low) & (lag < high)
+            if not inside.all():
+                reference, spike, lag = reference[inside], spike[inside], lag[inside]
+            yield reference, spike, lag
+        start = stop
+
+def binned_rates(units, bin_size, start=0.0, stop=None):
+    """
+    This function takes the following input:
+        units - a SpikeTrain or array of spike times, or a sequence or dict
+            of them
+        bin_size - width of each bin in seconds
+        start, stop - time span to bin; stop defaults to just past the last
+            spike
+
+    This function returns the following output:
+        rates - firing rate in spikes per second of each unit in each bin
+            (units x bins, or one row for a single unit)
+        edges - the bins + 1 bin edges in seconds; bin k holds the spikes
+            with edges[k] <= time < edges[k + 1]
+    """
+    times, single = unit_times(units)
+    if stop is None:
+        last = max([unit[-1] for unit in times if len(unit)] or [start])
+        n_bins = int(np.floor((last - start) / bin_size)) + 1
+    else:
+        n_bins = max(1, int(np.ceil(round((stop - start) / float(bin_size), 9))))
+    edges = start + bin_size * np.arange(n_bins + 1)
+
+    rates = np.empty((len(times), n_bins))
+    for number, unit in enumerate(times):
+        low, high = np.searchsorted(unit, [edges[0], edges[-1]], 'left')
+        bins = np.searchsorted(edges, unit[low:high], 'right') - 1
+        rates[number] = np.bincount(bins, minlength=n_bins)
+    rates /= bin_size
+    return (rates[0] if single else rates), edges
+
+def psth(units, events, window=(-.5, 1.0), bin_size=.01, chunk=PAIR_CHUNK):
+    """
+    This function takes the following input:
+        units - a SpikeTrain or array of spike times, or a sequence or dict
+            of them
+        events - times of the stimulus (or other event) in seconds
+        window - (before, after): span of lags around each event, in
+            seconds (before is usually negative)
+        bin_size - width of each lag bin in seconds
+
+    This function returns the following output:
+        rates - mean firing rate in spikes per second around the events,
+            in each lag bin (units x bins, or one row for a single unit)
+        edges - the bins + 1 lag bin edges in seconds, relative to the events
+    """
+    times, single = unit_times(units)
+    events = np.asarray(events, dtype=np.float64).ravel()
+    before, after = window
+    n_bins = max(1, int(np.ceil(round((after - before) / float(bin_size), 9))))
+    edges = before + bin_size * np.arange(n_bins + 1)
+
+    merged, labels = merge_units(times)
+    counts = np.zeros(len(times) * n_bins, dtype=np.intp)
+    for reference, spike, lag in window_pairs(merged, events, edges[0], edges[-1], chunk):
+        bins = np.searchsorted(edges, lag, 'right') - 1
+        counts += np.bincount(labels[spike] * n_bins + bins, minlength=len(counts))
+    rates = counts.reshape(len(times), n_bins) / (max(1, len(events)) * float(bin_size))
+    return (rates[0] if single else rates), edges
+
+def correlograms(units, window=.05, bin_size=.001, chunk=PAIR_CHUNK):
+    """
+    This function takes the following input:
+        units - a SpikeTrain or array of spike times, or a sequence or dict
+            of them
+        window - largest lag in seconds, either way
+        bin_size - width of each lag bin in seconds
+
+    This function returns the following output:
+        counts - counts[i, j, k] is the number of pairs of a spike of unit
+            i at t and a spike of unit j at t + lag, lag nearest lags[k]
+            (ties away from zero, so counts[j, i] is exactly counts[i, j]
+            reversed); counts[i, i] are the autocorrelograms, without each
+            spike's pairing with itself
+        lags - the lag at the centre of each bin, in seconds; the middle
+            bin is centred on zero
+    """
+    times, single = unit_times(units)
+    half = int(round(window / float(bin_size)))
+    n_bins = 2 * half + 1
+    reach = (half + .5) * bin_size
+    n_units = len(times)
+
+    merged, labels = merge_units(times)
+    # each pair of spikes is counted once, from the earlier one (in merged
+    # order); the bins are mirrored about zero, so the pair's bin seen from
+    # the later spike is the same distance the other side of the middle
+    forward = np.zeros(n_units * n_units * (half + 1), dtype=np.intp)
+    for reference, spike, lag in window_pairs(merged, merged, 0.0, reach, chunk):
+        steps = np.floor(lag / bin_size + .5).astype(np.intp)
+        keep = (spike > reference) & (steps <= half)
+        pair = labels[reference] * n_units + labels[spike]
+        forward += np.bincount((pair * (half + 1) + steps)[keep], minlength=len(forward))
+    forward = forward.reshape(n_units, n_units, half + 1)
+    counts = np.zeros((n_units, n_units, n_bins), dtype=np.intp)
+    counts[:, :, half:] = forward
+    counts[:, :, :half + 1] += forward.transpose(1, 0, 2)[:, :, ::-1]
+    return counts, (np.arange(n_bins) - half) * bin_size
+
+def autocorrelogram(train, window=.05, bin_size=.001):
+    """Returns (counts, lags) of the autocorrelogram of one unit (see correlograms)"""
+    counts, lags = correlograms([train], window, bin_size)
+    return counts[0, 0], lags
+
+def crosscorrelogram(train, other, window=.05, bin_size=.001):
+    """
+    Returns (counts, lags) of the cross-correlogram of two units: the
+    number of pairs of a spike of train at t and one of other at t + lag
+    (see correlograms)
+    """
+    counts, lags = correlograms([train, other], window, bin_size)
+    return counts[0, 1], lags
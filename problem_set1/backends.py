@@ -0,0 +1,255 @@
+#
+#  NAME
+#    backends.py
+#
+#  DESCRIPTION
+#    Compute backends for the two sequential detection kernels behind
+#    good_AP_finder: the scan for runs of three steep slopes and the
+#    refinement of each run to its local peak.  Every detector path
+#    (good_AP_finder, streaming, online, candidate tables) calls them
+#    through problem_set1.find_steep_runs and refine_peaks, which hand the
+#    work to the current backend:
+#        numpy - the reference, vectorized NumPy
+#        numba - the same kernels as compiled loops (jit_kernels.py), when
+#            numba is installed; compiled code is cached on disk, so later
+#            processes and workers load it instead of recompiling
+#    numba is meant to find identical spike indices, but it is opt-in: the
+#    default is numpy, and numba is only used when asked for, at runtime:
+#
+#        backends.use('numba')                   # from now on
+#        with backends.using('numpy'): ...       # for a block
+#        AP_BACKEND=numba python batch.py ...    # default for a process
+#
+#    'auto' asks for numba when it can be imported, else numpy.
+#    Run this module to check that every available backend agrees, on
+#    synthetic recordings and on any recordings given:
+#        python backends.py -d spikes_hard_practice.npy
+#
+
+import argparse
+import os
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+# environment variable naming the default backend
+ENV = 'AP_BACKEND'
+# backend used when ENV is not set
+DEFAULT = 'numpy'
+# number of candidate windows gathered at once when refining local peaks
+PEAK_BLOCK = 65536
+
+# The detector works in the voltage's own type: float64, float32, or
+# integer ADC counts.  Integer differences and absolute values are widened
+# so they cannot overflow (abs(-32768) is -32768 in int16).
+
+def slopes(voltage):
+    """Returns np.diff(voltage), widened for integer samples"""
+    if voltage.dtype.kind in 'iu':
+        wide = np.int32 if voltage.dtype.itemsize < 4 else np.int64
+        return np.subtract(voltage[1:], voltage[:-1], dtype=wide)
+    return np.diff(voltage)
+
+def magnitude(values):
+    """Returns np.abs(values), widened for integer samples"""
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        values = values.astype(np.int64)
+    return np.abs(values)
+
+class NumpyBackend(object):
+    """The reference kernels, in vectorized NumPy"""
+
+    name = 'numpy'
+
+    def find_steep_runs(self, voltage, AP_SLOPE):
+        # slopes() is already wide enough for abs() not to overflow
+        steep = np.abs(slopes(voltage)) > AP_SLOPE
+        return np.flatnonzero(steep[:-2] & steep[1:-1] & steep[2:])
+
+    def refine_peaks(self, voltage, centers, SPREAD):
+        centers = np.asarray(centers, dtype=np.intp)
+        offsets = np.arange(-SPREAD, SPREAD + 1)
+        # rank every offset by distance from the center, left side first
+        rank = 2 * np.abs(offsets) + (offsets > 0)
+        no_match = 2 * len(offsets)
+        peaks = np.empty(len(centers), dtype=np.intp)
+        for start in range(0, len(centers), PEAK_BLOCK):
+            block = centers[start:start + PEAK_BLOCK]
+            window = np.clip(block[:, np.newaxis] + offsets, 0, len(voltage) - 1)
+            sample = voltage[window]
+            high = sample.max(axis=1)
+            low = sample.min(axis=1)
+            local_peak = np.where(magnitude(high) > magnitude(low), high, low)
+            nearest = np.where(sample == local_peak[:, np.newaxis], rank, no_match).argmin(axis=1)
+            peaks[start:start + len(block)] = window[np.arange(len(block)), nearest]
+        return peaks
+
+    def warm_up(self, dtype):
+        pass
+
+class NumbaBackend(object):
+    """
+    The kernels compiled by numba (see jit_kernels.py).  Creating one
+    raises ImportError when numba is not installed.
+    """
+
+    name = 'numba'
+
+    def __init__(self):
+        import jit_kernels
+        self.kernels = jit_kernels
+
+    def find_steep_runs(self, voltage, AP_SLOPE):
+        voltage = np.asarray(voltage)
+        # numpy compares float samples with a Python float in the samples'
+        # own type, so the loops must too for the same runs
+        if voltage.dtype.kind == 'f':
+            AP_SLOPE = voltage.dtype.type(AP_SLOPE)
+        else:
+            AP_SLOPE = float(AP_SLOPE)
+        return self.kernels.steep_runs(voltage, AP_SLOPE)
+
+    def refine_peaks(self, voltage, centers, SPREAD):
+        return self.kernels.refine_peaks(np.asarray(voltage),
+                                         np.asarray(centers, dtype=np.intp), int(SPREAD))
+
+    def warm_up(self, dtype):
+        """Compiles (or loads from the cache) the kernels for samples of dtype"""
+        voltage = np.zeros(8, dtype=dtype)
+        self.refine_peaks(voltage, self.find_steep_runs(voltage, 0.0), 2)
+
+BACKENDS = OrderedDict([('numpy', NumpyBackend), ('numba', NumbaBackend)])
+
+_loaded = {}
+_current = None
+
+def get(name):
+    """
+    Returns the backend called name ('auto' for numba if available, else
+    numpy).  Raises ValueError for an unknown name and ImportError if the
+    backend's package is not installed.
+    """
+    if name == 'auto':
+        return get('numba') if 'numba' in available() else get('numpy')
+    if name not in BACKENDS:
+        raise ValueError('backend must be one of %s, got %r'
+                         % (('auto',) + tuple(BACKENDS), name))
+    if name not in _loaded:
+        _loaded[name] = BACKENDS[name]()
+    return _loaded[name]
+
+def available():
+    """Returns the names of the backends that can be used here"""
+    names = []
+    for name in BACKENDS:
+        try:
+            get(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def current():
+    """Returns the active backend, chosen by AP_BACKEND (else DEFAULT) on first use"""
+    global _current
+    if _current is None:
+        _current = get(os.environ.get(ENV, DEFAULT))
+    return _current
+
+def use(name):
+    """Makes the backend called name the active one and returns it"""
+    global _current
+    _current = get(name)
+    return _current
+
+@contextmanager
+def using(name):
+    """Runs the enclosed block with the backend called name, which it yields"""
+    global _current
+    previous = _current
+    backend = use(name)
+    try:
+        yield backend
+    finally:
+        _current = previous
+
+def parity(time, voltage, name, reference='numpy', loose_slope_ratio=.5, **params):
+    """
+    Returns the names of the checks on which backend name finds different
+    spike indices from the reference backend, for one recording (an empty
+    list means they agree):
+        runs, peaks - find_steep_runs and refine_peaks with a slope limit
+            of loose_slope_ratio standard deviations, which passes many
+            noise candidates and so many peak ties
+        good_AP_finder - detection with params
+    """
+    import problem_set1
+    voltage = np.asarray(voltage)
+    SAMPLING_RATE = time[1]-time[0]
+    stats = (float(voltage.max()), float(voltage.min()), problem_set1.voltage_std(voltage))
+    THRESHOLD, AP_SLOPE, SPREAD = problem_set1.AP_constants(SAMPLING_RATE, *stats,
+                                                           slope_ratio=loose_slope_ratio)
+    results = []
+    for backend in (reference, name):
+        with using(backend):
+            runs = problem_set1.find_steep_runs(voltage, AP_SLOPE)
+            peaks = problem_set1.refine_peaks(voltage, runs + 2, SPREAD)
+            indices = problem_set1.good_AP_finder(time, voltage, **params).indices
+        results.append((runs, peaks, indices))
+    return [check for check, expected, found in zip(('runs', 'peaks', 'good_AP_finder'),
+                                                    results[0], results[1])
+            if not np.array_equal(expected, found)]
+
+def main(argv=None):
+    import synthetic
+    from problem_set1 import load_data
+
+    parser = argparse.ArgumentParser(description='Check the detection backends find the same spikes.')
+    parser.add_argument('-b', '--backends', nargs='+', choices=list(BACKENDS),
+                        help='backends to check against numpy (default: every available one)')
+    parser.add_argument('-d', '--data', action='append', default=[], metavar='RECORDING',
+                        help='also check this recording (repeatable)')
+    parser.add_argument('--duration', type=float, default=20.0,
+                        help='seconds of each synthetic recording')
+    args = parser.parse_args(argv)
+
+    names = args.backends or available()
+    missing = [name for name in names if name not in available()]
+    if missing:
+        parser.error('backend %s is not available here (is it installed?)' % ', '.join(missing))
+    recordings = []
+    for dtype in ('int16', 'uint16', 'float32', 'float64'):
+        for noise in (10.0, 40.0):
+            # unsigned counts are signed ones offset by half the range, as an
+            # offset-binary ADC would record them
+            synthetic_recording = synthetic.SyntheticRecording(
+                duration=args.duration, noise=noise, seed=len(recordings),
+                dtype='int16' if dtype == 'uint16' else dtype)
+            voltage = synthetic_recording.voltage()
+            if dtype == 'uint16':
+                voltage = (voltage.astype(np.int32) + 32768).astype(np.uint16)
+            recordings.append(('synthetic %s noise %g' % (dtype, noise),
+                               synthetic_recording.timebase, voltage))
+    for filename in args.data:
+        time, voltage, gain = load_data(filename, counts=True)
+        recordings.append((filename, time, voltage))
+
+    failures = 0
+    print '%-40s %s' % ('recording', ' '.join('%-24s' % name for name in names))
+    for label, time, voltage in recordings:
+        row = []
+        for name in names:
+            mismatches = parity(time, voltage, name)
+            failures += len(mismatches)
+            row.append('%-24s' % ('same' if not mismatches else 'DIFFERENT: ' + ','.join(mismatches)))
+        print '%-40s %s' % (label, ' '.join(row))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    # run as the backends module problem_set1 imports, so that use() and
+    # using() switch the backend the detectors actually call
+    import backends
+    sys.exit(backends.main(sys.argv[1:]))
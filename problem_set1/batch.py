@@ -0,0 +1,272 @@
+#
+#  NAME
+#    batch.py
+#
+#  DESCRIPTION
+#    Batch spike detection over directories of recordings.  Recording files
+#    (.rec, and legacy spikes_*.npy files that have no .rec beside them) are
+#    found under the given paths and each is loaded, detected and - when an
+#    answers file <name>_answers.npy sits next to it - scored, one file per
+#    task across a pool of worker processes.  A file that fails is recorded
+#    as an error and the batch carries on.
+#
+#    Everything goes to one output directory:
+#        results.jsonl - one JSON line per finished file: its path, size,
+#            mtime, the detector settings, status and metrics
+#        spikes/<name>.<channel>.npz - each channel's SpikeTrain
+#    A line is only written once a file's spikes are on disk, so the results
+#    file doubles as the checkpoint: rerunning the same command skips every
+#    file already done with the same settings (and retries the errors).
+#        python batch.py sessions/ -o results/ --band 300 6000
+#        python batch.py sessions/ -o results/     # after an interruption
+#    --backend picks the detection kernels (see backends.py); every backend
+#    finds the same spikes, so it is not part of the checkpointed settings.
+#
+
+import argparse
+import fnmatch
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time as wallclock
+import traceback
+from collections import OrderedDict
+
+import backends
+from problem_set1 import load_data, good_AP_finder, get_actual_times, score_detector, \
+    THRESHOLD_RATIO, SLOPE_RATIO, SPREAD_TIME
+from pyramid import open_summary
+from recording import EXTENSION, is_recording
+from spiketrain import SpikeTrain
+
+RESULTS = 'results.jsonl'
+SPIKES = 'spikes'
+ANSWERS_SUFFIX = '_answers'
+PATTERNS = ('*' + EXTENSION, '*.npy')
+
+def discover(paths, patterns=PATTERNS):
+    """
+    Returns the sorted recording files among paths (files, or directories
+    searched recursively).  Answers files are left out, and so is a legacy
+    .npy file with a converted .rec beside it.
+    """
+    found = set()
+    for path in paths:
+        if os.path.isfile(path):
+            found.add(os.path.abspath(path))
+            continue
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories.sort()
+            for filename in filenames:
+                if any(fnmatch.fnmatch(filename, pattern) for pattern in patterns):
+                    found.add(os.path.abspath(os.path.join(directory, filename)))
+    recordings = []
+    for filename in sorted(found):
+        stem, extension = os.path.splitext(filename)
+        if stem.endswith(ANSWERS_SUFFIX):
+            continue
+        if extension != EXTENSION and stem + EXTENSION in found:
+            continue
+        recordings.append(filename)
+    return recordings
+
+def answers_file(filename):
+    """Returns the answers file beside a recording, or None if there is none"""
+    candidate = os.path.splitext(filename)[0] + ANSWERS_SUFFIX + '.npy'
+    return candidate if os.path.exists(candidate) else None
+
+def spikes_name(filename, channel):
+    """Returns the spikes file name (within SPIKES) of one channel of a recording"""
+    stem = os.path.splitext(os.path.abspath(filename))[0].strip(os.sep)
+    return '%s.%s.npz' % (stem.replace(os.sep, '__'), channel)
+
+def settings_key(params):
+    """Returns the settings of a run as a canonical string"""
+    return json.dumps(params, sort_keys=True)
+
+def read_results(output):
+    """
+    Returns the finished files in an output directory, as an OrderedDict
+    from recording path to its latest result record
+    """
+    records = OrderedDict()
+    path = os.path.join(output, RESULTS)
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run may be cut short
+                continue
+            records.pop(record['file'], None)
+            records[record['file']] = record
+    return records
+
+def load_spikes(output, record):
+    """Returns an OrderedDict from channel to SpikeTrain for one result record"""
+    return OrderedDict((channel, SpikeTrain.load(os.path.join(output, SPIKES, name)))
+                       for channel, name in record['spikes'])
+
+def is_done(record, stat, settings):
+    """True if record is a successful run of the file as it is now, with settings"""
+    return (record['status'] == 'ok' and record['settings'] == settings and
+            record['size'] == stat.st_size and record['mtime'] == stat.st_mtime)
+
+def _save(train, path):
+    # write then rename, so a spikes file is never seen half written
+    handle, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+    with os.fdopen(handle, 'wb') as f:
+        train.save(f)
+    os.rename(temp, path)
+
+def process_file(filename, output, params):
+    """
+    Detects (and scores, if it has answers) one recording, saves its spikes
+    under output and returns its metrics
+    """
+    metrics = OrderedDict()
+    began = wallclock.time()
+    time, voltage, gain = load_data(filename, multichannel=True, counts=True)
+    metrics['channels'] = len(voltage)
+    metrics['samples'] = len(time)
+    metrics['duration'] = len(time) * (time[1] - time[0])
+    # the summary is built on a recording's first run and reused after
+    summary = open_summary(filename, counts=True) if is_recording(filename) else None
+    metrics['load seconds'] = wallclock.time() - began
+
+    began = wallclock.time()
+    spikes = []
+    counts = []
+    for channel in range(len(voltage)):
+        stats = None if summary is None else summary.stats(channel=channel)
+        APTimes = good_AP_finder(time, voltage[channel], gain=gain[channel], stats=stats,
+                                 **params)
+        name = spikes_name(filename, channel)
+        _save(APTimes, os.path.join(output, SPIKES, name))
+        spikes.append((channel, name))
+        counts.append(len(APTimes))
+    metrics['spikes'] = counts
+    metrics['detect seconds'] = wallclock.time() - began
+
+    answers = answers_file(filename)
+    if answers is not None and len(voltage) == 1:
+        metrics.update(score_detector(APTimes, get_actual_times(answers)))
+    return spikes, metrics
+
+def _process_task(task):
+    filename, output, params = task
+    stat = os.stat(filename)
+    record = OrderedDict([('file', filename), ('size', stat.st_size),
+                          ('mtime', stat.st_mtime), ('settings', settings_key(params))])
+    try:
+        record['spikes'], record['metrics'] = process_file(filename, output, params)
+        record['status'] = 'ok'
+    except Exception:
+        record['status'] = 'error'
+        record['error'] = traceback.format_exc()
+    return record
+
+def run_batch(paths, output, processes=None, verbose=True, backend=None, **params):
+    """
+    This function takes the following input:
+        paths - recording files and directories to search (see discover)
+        output - output directory, created if need be
+        processes - worker processes (default one per core; 1 runs in
+            this process)
+        verbose - print a line per file and a summary
+        backend - detection backend for this process and the workers (see
+            backends.py; default the current one)
+        params - good_AP_finder settings (threshold_ratio, slope_ratio,
+            spread_time, band)
+
+    This function returns the following output:
+        records - the result record of every recording found, finished in
+            this run or an earlier one, in file order
+    """
+    if backend is not None:
+        backends.use(backend)
+    spikes_directory = os.path.join(output, SPIKES)
+    if not os.path.isdir(spikes_directory):
+        os.makedirs(spikes_directory)
+    settings = settings_key(params)
+    files = discover(paths)
+    done = read_results(output)
+    todo = [filename for filename in files
+            if not (filename in done and is_done(done[filename], os.stat(filename), settings))]
+    # largest first, so a big file does not start last and hold up the end
+    todo.sort(key=lambda filename: -os.path.getsize(filename))
+    tasks = [(filename, output, params) for filename in todo]
+    if verbose:
+        print '%d recordings, %d already done, %d to process' % (
+            len(files), len(files) - len(todo), len(todo))
+
+    began = wallclock.time()
+    samples = 0
+    errors = 0
+    pool = None
+    if processes == 1:
+        results = (_process_task(task) for task in tasks)
+    else:
+        # named again in each worker, for where processes are spawned
+        pool = multiprocessing.Pool(processes, backends.use, (backends.current().name,))
+        results = pool.imap_unordered(_process_task, tasks)
+    try:
+        with open(os.path.join(output, RESULTS), 'a') as results_file:
+            for record in results:
+                results_file.write(json.dumps(record) + '\n')
+                results_file.flush()
+                os.fsync(results_file.fileno())
+                done.pop(record['file'], None)
+                done[record['file']] = record
+                if record['status'] == 'ok':
+                    samples += record['metrics']['samples'] * record['metrics']['channels']
+                    if verbose:
+                        print '%-60s %s spikes' % (record['file'], record['metrics']['spikes'])
+                else:
+                    errors += 1
+                    if verbose:
+                        print '%-60s ERROR %s' % (record['file'],
+                                                   record['error'].strip().splitlines()[-1])
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    elapsed = wallclock.time() - began
+    if verbose and todo:
+        print '%d files in %.1f s (%.0f samples/s), %d errors' % (
+            len(todo), elapsed, samples / elapsed if elapsed else 0, errors)
+    return [done[filename] for filename in files if filename in done]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Detect spikes in every recording under some paths.')
+    parser.add_argument('paths', nargs='+', help='recording files or directories')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('-p', '--processes', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--threshold-ratio', type=float, default=THRESHOLD_RATIO)
+    parser.add_argument('--slope-ratio', type=float, default=SLOPE_RATIO)
+    parser.add_argument('--spread-time', type=float, default=SPREAD_TIME)
+    parser.add_argument('--band', type=float, nargs=2, metavar=('LOW', 'HIGH'),
+                        help='bandpass filter to LOW-HIGH Hz before detecting')
+    parser.add_argument('--backend', choices=['auto'] + list(backends.BACKENDS),
+                        help='detection backend (default: $%s, else %s)'
+                             % (backends.ENV, backends.DEFAULT))
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+    if args.backend not in (None, 'auto') and args.backend not in backends.available():
+        parser.error('backend %s is not available here (is it installed?)' % args.backend)
+
+    records = run_batch(args.paths, args.output, args.processes, not args.quiet, args.backend,
+                        threshold_ratio=args.threshold_ratio, slope_ratio=args.slope_ratio,
+                        spread_time=args.spread_time,
+                        band=tuple(args.band) if args.band else None)
+    return 1 if any(record['status'] != 'ok' for record in records) else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
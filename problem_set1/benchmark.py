@@ -0,0 +1,304 @@
+#
+#  NAME
+#    benchmark.py
+#
+#  DESCRIPTION
+#    Speed and memory benchmarks on synthetic recordings (see synthetic.py).
+#    For each recording length, a recording is written to a temporary .rec
+#    file and load_data, good_AP_finder, score_detector (the scoring behind
+#    detector_tester), plot_waveforms and sort_spikes (sorting.py) are timed,
+#    each in a forked child
+#    process so its peak memory can be measured on its own.  Results are
+#    written as JSON so runs of different versions can be compared:
+#        python benchmark.py --durations 1 10 60 600 3600 -o before.json
+#        python benchmark.py --durations 1 10 60 600 3600 -o after.json --compare before.json
+#    Recordings are int16 counts, like acquisition hardware writes them,
+#    and the stages get them the way users do, from load_data(filename) (a
+#    ScaledView of the counts); --counts runs them on the raw counts and
+#    their gain instead, --dtype float64 measures the older all-float64
+#    path, and --backend times the detection kernels of another backend
+#    (see backends.py).
+#
+#    --check-imports instead times importing each headless module in a fresh
+#    interpreter and fails if one takes longer than IMPORT_BUDGET seconds
+#    (on top of numpy) or pulls in matplotlib:
+#        python benchmark.py --check-imports
+#
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time as wallclock
+
+import numpy as np
+import matplotlib
+# benchmarks run headless; this has to happen before pylab is imported
+matplotlib.use('Agg')
+
+import backends
+import synthetic
+
+DURATIONS = [1.0, 10.0, 60.0, 600.0]
+STAGES = ('load_data', 'good_AP_finder', 'score_detector', 'plot_waveforms', 'sort_spikes')
+# modules that must import quickly and without matplotlib
+HEADLESS_MODULES = ('problem_set1', 'backends', 'recording', 'streaming', 'cache', 'pyramid',
+                    'multichannel', 'online', 'sweep', 'batch')
+# seconds to import one of them, numpy already loaded
+IMPORT_BUDGET = 0.15
+
+_IMPORT_TIMER = """
+import json, sys, time
+import numpy
+began = time.time()
+import %s
+print(json.dumps({'seconds': time.time() - began,
+                  'matplotlib': 'matplotlib' in sys.modules}))
+"""
+
+def _rss_mb():
+    """Returns this process's resident memory in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+    except IOError:
+        return _peak_rss_mb()
+
+def _peak_rss_mb():
+    """Returns this process's peak resident memory in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+def _child(connection, function, args):
+    try:
+        baseline = _rss_mb()
+        began = wallclock.time()
+        value = function(*args)
+        elapsed = wallclock.time() - began
+        connection.send((elapsed, _peak_rss_mb() - baseline, value))
+    except Exception as error:
+        connection.send(error)
+    connection.close()
+
+def measure(function, *args):
+    """
+    Runs function(*args) in a forked child process and returns
+    (seconds, peak memory growth in MB, return value).  The arguments are
+    inherited through the fork, not pickled; the return value is pickled
+    back, so keep it small.
+    """
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_child, args=(child, function, args))
+    process.start()
+    child.close()
+    result = parent.recv()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def _load(filename, counts=False):
+    from problem_set1 import load_data
+    time, voltage = load_data(filename, counts=True)[:2] if counts else load_data(filename)
+    return len(voltage)
+
+def _detect(time, voltage):
+    from problem_set1 import good_AP_finder
+    return np.asarray(good_AP_finder(time, voltage))
+
+def _score(APTimes, actualTimes):
+    from problem_set1 import score_detector
+    return score_detector(APTimes, actualTimes)
+
+def _plot(time, voltage, APTimes):
+    import matplotlib.pylab as plt
+    from problem_set1 import plot_waveforms
+    plot_waveforms(time, voltage, APTimes, 'benchmark')
+    plt.gcf().canvas.draw()
+    plt.close('all')
+
+def _sort(time, voltage, APTimes):
+    from sorting import sort_spikes
+    sorting = sort_spikes(time, voltage, APTimes, n_units=len(synthetic.SHAPES))
+    return [len(unit) for unit in sorting.units.values()]
+
+def run(durations=DURATIONS, sample_rate=30000.0, noise=10.0, spike_rate=20.0, seed=0,
+        directory=None, stages=STAGES, dtype=np.int16, counts=False):
+    """
+    Benchmarks the stages on a synthetic recording of each duration and
+    returns a list of result dicts (stage, duration, samples, spikes,
+    seconds, samples and detected spikes per second and peak memory growth).
+    The stages get the recording from load_data(filename), or as raw counts
+    from load_data(filename, counts=True) if counts is True.
+    """
+    from problem_set1 import load_data
+
+    results = []
+    workdir = tempfile.mkdtemp(dir=directory)
+    try:
+        for duration in durations:
+            recording = synthetic.SyntheticRecording(duration=duration, sample_rate=sample_rate,
+                                                     noise=noise, spike_rate=spike_rate,
+                                                     seed=seed, dtype=dtype)
+            filename = recording.write(os.path.join(workdir, 'synthetic_%gs.rec' % duration))
+            actualTimes = recording.spike_times()
+            if counts:
+                time, voltage = load_data(filename, counts=True)[:2]
+            else:
+                time, voltage = load_data(filename)
+            APTimes = None
+
+            for stage in stages:
+                if stage == 'load_data':
+                    seconds, memory, value = measure(_load, filename, counts)
+                elif stage == 'good_AP_finder':
+                    seconds, memory, APTimes = measure(_detect, time, voltage)
+                    value = len(APTimes)
+                else:
+                    if APTimes is None:
+                        APTimes = _detect(time, voltage)
+                    if stage == 'score_detector':
+                        seconds, memory, value = measure(_score, APTimes, actualTimes)
+                    elif stage == 'plot_waveforms':
+                        seconds, memory, value = measure(_plot, time, voltage, APTimes)
+                    elif stage == 'sort_spikes':
+                        seconds, memory, value = measure(_sort, time, voltage, APTimes)
+                    else:
+                        raise ValueError('unknown stage %r' % stage)
+                results.append({'stage': stage,
+                                'duration': duration,
+                                'samples': len(voltage),
+                                'spikes': len(actualTimes),
+                                'seconds': seconds,
+                                'samples per second': len(voltage) / seconds if seconds else None,
+                                'spikes per second': (len(APTimes) / seconds
+                                                      if seconds and APTimes is not None else None),
+                                'peak memory MB': memory,
+                                'result': value if isinstance(value, (int, float, dict, list)) else None})
+            del time, voltage
+            os.remove(filename)
+    finally:
+        shutil.rmtree(workdir, True)
+    return results
+
+def import_time(module, repeat=3):
+    """
+    Returns (seconds, whether matplotlib got imported) for importing module
+    in a fresh interpreter, the best of repeat tries
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for attempt in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', _IMPORT_TIMER % module],
+                                         cwd=here)
+        result = json.loads(output.decode('ascii').strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best['seconds'], best['matplotlib']
+
+def check_imports(modules=HEADLESS_MODULES, budget=IMPORT_BUDGET):
+    """
+    Returns a list of (module, seconds, matplotlib imported, ok) for the
+    import of each module
+    """
+    checks = []
+    for module in modules:
+        seconds, plotting = import_time(module)
+        checks.append((module, seconds, plotting, seconds <= budget and not plotting))
+    return checks
+
+def environment():
+    """Returns the versions a result set was measured with"""
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd=here, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'revision': revision,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'backend': backends.current().name,
+            'machine': platform.machine(),
+            'cpus': multiprocessing.cpu_count(),
+            'timestamp': wallclock.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def compare(results, baseline):
+    """Returns text lines comparing results with a baseline result list"""
+    old = dict(((row['stage'], row['duration']), row) for row in baseline)
+    lines = ['%-16s %10s %12s %12s %8s' % ('stage', 'duration', 'before s', 'after s', 'ratio')]
+    for row in results:
+        before = old.get((row['stage'], row['duration']))
+        if before is None:
+            continue
+        lines.append('%-16s %10g %12.4f %12.4f %8.2f'
+                     % (row['stage'], row['duration'], before['seconds'], row['seconds'],
+                        row['seconds'] / before['seconds'] if before['seconds'] else np.nan))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the spike detection pipeline.')
+    parser.add_argument('--durations', nargs='+', type=float, default=DURATIONS,
+                        help='recording lengths in seconds')
+    parser.add_argument('--sample-rate', type=float, default=30000.0)
+    parser.add_argument('--noise', type=float, default=10.0)
+    parser.add_argument('--spike-rate', type=float, default=20.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dtype', default='int16', choices=['int16', 'float32', 'float64'],
+                        help='sample type of the synthetic recordings')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--counts', action='store_true',
+                        help='run the stages on the raw counts (load_data(counts=True)) '
+                             'instead of the scaled voltage users get by default')
+    parser.add_argument('--backend', choices=['auto'] + list(backends.BACKENDS),
+                        help='detection backend (default: $%s, else %s)'
+                             % (backends.ENV, backends.DEFAULT))
+    parser.add_argument('--tmpdir', help='where to write the synthetic recordings')
+    parser.add_argument('-o', '--output', default='benchmark_results.json',
+                        help='JSON file to write')
+    parser.add_argument('--compare', help='earlier JSON results to compare against')
+    parser.add_argument('--check-imports', action='store_true',
+                        help='only check the headless modules import within budget')
+    args = parser.parse_args(argv)
+
+    if args.check_imports:
+        checks = check_imports()
+        print '%-16s %10s %12s' % ('module', 'seconds', 'matplotlib')
+        for module, seconds, plotting, ok in checks:
+            print '%-16s %10.4f %12s %s' % (module, seconds, plotting, '' if ok else 'FAIL')
+        return 0 if all(ok for module, seconds, plotting, ok in checks) else 1
+
+    if args.backend not in (None, 'auto') and args.backend not in backends.available():
+        parser.error('backend %s is not available here (is it installed?)' % args.backend)
+    if args.backend:
+        backends.use(args.backend)
+    # compiled here, before the stages fork, so no stage times the compiler
+    backends.current().warm_up(np.dtype(args.dtype))
+    results = run(args.durations, args.sample_rate, args.noise, args.spike_rate, args.seed,
+                  args.tmpdir, args.stages, np.dtype(args.dtype), args.counts)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'counts': args.counts, 'results': results},
+                  f, indent=1)
+
+    print '%-16s %10s %12s %10s %14s %12s %10s' % ('stage', 'duration', 'samples', 'seconds',
+                                                    'samples/s', 'spikes/s', 'peak MB')
+    for row in results:
+        print '%-16s %10g %12d %10.4f %14.0f %12.0f %10.1f' % (
+            row['stage'], row['duration'], row['samples'], row['seconds'],
+            row['samples per second'] or 0, row.get('spikes per second') or 0,
+            row['peak memory MB'])
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print ''
+        print '\n'.join(compare(results, baseline))
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,195 @@
+#
+#  NAME
+#    cache.py
+#
+#  DESCRIPTION
+#    Caches detector output keyed by the content of the recording and the
+#    detector and its parameters, so detecting spikes on the same data with
+#    the same settings a second time is a lookup.  Results live in an
+#    in-process LRU and, optionally, as .npy files in a cache directory that
+#    survives between runs.  The key also holds DETECTOR_VERSION and a hash
+#    of the source of the detector's module, so results saved by an older
+#    detector are not served after its code changes.
+#
+
+import hashlib
+import inspect
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from problem_set1 import load_data, good_AP_finder
+from recording import Timebase
+from spiketrain import SpikeTrain
+
+# bytes hashed per read when fingerprinting a recording
+HASH_BLOCK = 1 << 24
+# bump whenever detection results change without the detector's own
+# module changing (e.g. in backends.py or recording.py)
+DETECTOR_VERSION = 1
+
+# (module, name, code) of a detector -> its source_digest
+_source_digests = {}
+
+def array_digest(time, voltage, block_size=HASH_BLOCK):
+    """Returns a hex SHA-1 of a recording's time axis and voltage samples"""
+    sha1 = hashlib.sha1()
+    for values in (time, voltage):
+        if isinstance(values, Timebase):
+            sha1.update(repr(values).encode('ascii'))
+            continue
+        values = np.asanyarray(values)
+        sha1.update(('%s%r' % (values.dtype.str, values.shape)).encode('ascii'))
+        flat = values.reshape(-1)
+        step = max(1, block_size // max(1, values.itemsize))
+        for start in range(0, len(flat), step):
+            sha1.update(np.ascontiguousarray(flat[start:start + step]).view(np.uint8))
+    return sha1.hexdigest()
+
+def file_digest(filename, block_size=HASH_BLOCK):
+    """Returns a hex SHA-1 of the bytes of filename"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            sha1.update(block)
+            block = f.read(block_size)
+    return sha1.hexdigest()
+
+def source_digest(detector):
+    """
+    Returns a hex SHA-1 of the source file of detector's module, or '' if it
+    has none (e.g. a detector defined at the interactive prompt).  The file
+    is hashed once per detector; a detector reloaded from an edited module
+    has new code, and is hashed again.
+    """
+    key = (detector.__module__, detector.__name__, getattr(detector, '__code__', None))
+    if key not in _source_digests:
+        try:
+            filename = inspect.getsourcefile(detector)
+            with open(filename, 'rb') as f:
+                _source_digests[key] = hashlib.sha1(f.read()).hexdigest()
+        except (TypeError, IOError):
+            _source_digests[key] = ''
+    return _source_digests[key]
+
+def detector_key(digest, detector, params):
+    """
+    Returns the cache key for running detector(**params) on a recording:
+    the recording's digest, the detector's name, DETECTOR_VERSION, the
+    source_digest of the detector and the parameters
+    """
+    name = '%s.%s' % (detector.__module__, detector.__name__)
+    settings = ','.join('%s=%r' % item for item in sorted(params.items()))
+    return hashlib.sha1(('%s|%s|%d|%s|%s' % (digest, name, DETECTOR_VERSION,
+                                             source_digest(detector), settings)
+                         ).encode('utf-8')).hexdigest()
+
+class DetectionCache(object):
+    """
+    Two-tier cache of detected spikes (SpikeTrains, or plain spike times
+    from detectors that return lists).
+        maxsize - number of results kept in memory (least recently used
+            results are dropped first)
+        directory - optional directory for the on-disk tier; results found
+            there are promoted to memory
+    """
+
+    def __init__(self, maxsize=32, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        # filename -> (size, mtime, digest), so unchanged files are not rehashed
+        self._file_digests = {}
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def get(self, key):
+        """Returns the cached spikes for key, or None"""
+        if key in self._memory:
+            value = self._memory.pop(key)
+            self._memory[key] = value
+            return value
+        if self.directory is not None:
+            if os.path.exists(self._path(key, '.npz')):
+                value = SpikeTrain.load(self._path(key, '.npz'))
+            elif os.path.exists(self._path(key, '.npy')):
+                value = np.load(self._path(key, '.npy'))
+            else:
+                return None
+            self._remember(key, value)
+            return value
+        return None
+
+    def put(self, key, APTimes):
+        """Stores spikes under key in both tiers"""
+        if isinstance(APTimes, SpikeTrain):
+            value, extension = APTimes, '.npz'
+        else:
+            value, extension = np.array(APTimes, dtype=np.float64), '.npy'
+        self._remember(key, value)
+        if self.directory is not None:
+            # write then rename, so a reader never sees half a file
+            handle, temp = tempfile.mkstemp(dir=self.directory, suffix=extension)
+            with os.fdopen(handle, 'wb') as f:
+                if isinstance(value, SpikeTrain):
+                    value.save(f)
+                else:
+                    np.save(f, value)
+            os.rename(temp, self._path(key, extension))
+        return value
+
+    def _remember(self, key, value):
+        self._memory.pop(key, None)
+        self._memory[key] = value
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        """Empties the in-memory tier (the directory is left alone)"""
+        self._memory.clear()
+        self._file_digests.clear()
+
+    def _lookup(self, digest, detector, params, run):
+        key = detector_key(digest, detector, params)
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+            value = self.put(key, run())
+        else:
+            self.hits += 1
+        # spike trains are never modified in place; plain times are copied
+        return value if isinstance(value, SpikeTrain) else list(value)
+
+    def detect(self, time, voltage, detector=good_AP_finder, **params):
+        """
+        Returns detector(time, voltage, **params), reusing a cached result
+        when the same samples were seen before with the same settings
+        """
+        return self._lookup(array_digest(time, voltage), detector, params,
+                            lambda: detector(time, voltage, **params))
+
+    def detect_file(self, filename, detector=good_AP_finder, **params):
+        """
+        Like detect, but keyed on the bytes of filename.  The file is only
+        loaded on a miss, and only rehashed if its size or mtime changed.
+        """
+        stat = os.stat(filename)
+        known = self._file_digests.get(filename)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime):
+            digest = known[2]
+        else:
+            digest = file_digest(filename)
+            self._file_digests[filename] = (stat.st_size, stat.st_mtime, digest)
+
+        def run():
+            time, voltage = load_data(filename)
+            return detector(time, voltage, **params)
+        return self._lookup(digest, detector, params, run)
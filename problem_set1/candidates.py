@@ -0,0 +1,143 @@
+#
+#  NAME
+#    candidates.py
+#
+#  DESCRIPTION
+#    Two-phase spike detection for tuning.  Finding steep slope runs and
+#    refining their peaks is the expensive part of good_AP_finder; the
+#    threshold test after it is cheap.  A CandidateTable does the expensive
+#    part once, for every run at least as steep as the loosest slope to be
+#    tried, and keeps for each run its start, refined peak, peak voltage and
+#    slope (the smallest of its three slopes).  Any THRESHOLD, and any
+#    AP_SLOPE from that loosest one up, is then applied to the table alone:
+#
+#        table = CandidateTable.build(time, voltage, min_slope_ratio=1.5)
+#        for threshold_ratio in np.linspace(.2, .8, 61):
+#            APTimes = table.AP_finder(threshold_ratio, slope_ratio=2.5)
+#
+#    The result is the same as good_AP_finder with the same settings.  The
+#    table is tied to one spread_time (the peak refinement window).
+#
+
+import numpy as np
+
+import filtering
+import instrument
+from backends import slopes, magnitude
+from problem_set1 import AP_constants, refine_peaks, voltage_std, detection_input, \
+    THRESHOLD_RATIO, SLOPE_RATIO, SPREAD_TIME
+from spiketrain import SpikeTrain
+from streaming import BLOCK_SIZE, iter_blocks
+
+def run_slopes(voltage):
+    """
+    Returns, for every i, the smallest of the three slope magnitudes
+    starting at voltage[i]; the run at i is steeper than AP_SLOPE exactly
+    when this is greater than AP_SLOPE
+    """
+    steepness = np.abs(slopes(voltage))
+    return np.minimum(np.minimum(steepness[:-2], steepness[1:-1]), steepness[2:])
+
+class CandidateTable(object):
+    """
+    Every slope run of voltage steeper than min_slope, with its refined
+    peak (within SPREAD samples):
+        runs - sample index where each run starts
+        peaks - sample index of its local peak
+        amplitudes - voltage at the peak
+        steepness - smallest of the run's three slope magnitudes
+    Runs are in order of their start.
+    """
+
+    def __init__(self, voltage, SPREAD, min_slope, block_size=BLOCK_SIZE):
+        self.SPREAD = SPREAD
+        self.min_slope = min_slope
+        n = len(voltage)
+        run = instrument.current()
+        columns = []
+        for start, stop in iter_blocks(n, block_size):
+            # as in streaming.stream_AP_indices: runs starting in the block,
+            # with enough overlap for their peak windows
+            seg_start = max(0, min(start, start + 2 - SPREAD))
+            seg_stop = min(n, stop + 3 + SPREAD)
+            segment = np.asarray(voltage[seg_start:seg_stop])
+            with run.stage('slope scan'):
+                steepness = run_slopes(segment)
+                runs = np.flatnonzero(steepness > min_slope)
+                runs = runs[(runs + seg_start >= start) & (runs + seg_start < stop)]
+            run.count('candidates examined', len(runs))
+            peaks = refine_peaks(segment, runs + 2, SPREAD)
+            # kept in the voltage's own type, so comparisons match AP_indices
+            columns.append((runs + seg_start, peaks + seg_start, segment[peaks],
+                            steepness[runs]))
+        if columns:
+            self.runs, self.peaks, self.amplitudes, self.steepness = \
+                [np.concatenate(column) for column in zip(*columns)]
+        else:
+            self.runs = self.peaks = np.array([], dtype=np.intp)
+            self.amplitudes = self.steepness = np.array([], dtype=np.float64)
+
+    @classmethod
+    def build(cls, time, voltage, spread_time=SPREAD_TIME, min_slope_ratio=SLOPE_RATIO,
+              band=None, gain=None, stats=None, block_size=BLOCK_SIZE):
+        """
+        Returns the CandidateTable of a recording for AP_finder, taking the
+        arguments of good_AP_finder; slope_ratio can later be anything from
+        min_slope_ratio up
+        """
+        if (len(voltage) != len(time)):
+            raise ValueError('time and voltage are not the same length')
+        voltage, gain, stats = detection_input(voltage, gain, stats)
+        voltage = np.asarray(voltage)
+        run = instrument.current()
+        SAMPLING_RATE = time[1]-time[0]
+        if band is not None:
+            with run.stage('filter'):
+                voltage = filtering.bandpass(voltage, 1.0 / SAMPLING_RATE, *band)
+            stats = None
+        with run.stage('stats'):
+            if stats is None:
+                stats = (float(voltage.max()), float(voltage.min()), voltage_std(voltage))
+        THRESHOLD, AP_SLOPE, SPREAD = AP_constants(SAMPLING_RATE, *stats,
+                                                   slope_ratio=min_slope_ratio,
+                                                   spread_time=spread_time)
+        table = cls(voltage, SPREAD, AP_SLOPE, block_size)
+        table.time = time
+        table.stats = stats
+        table.SAMPLING_RATE = SAMPLING_RATE
+        table.min_slope_ratio = min_slope_ratio
+        table.gain = 1.0 if gain is None else gain
+        return table
+
+    def __len__(self):
+        return len(self.runs)
+
+    def select(self, THRESHOLD, AP_SLOPE):
+        """
+        Returns the sorted, unique spike indices for THRESHOLD and AP_SLOPE,
+        the same as problem_set1.AP_indices
+        """
+        if AP_SLOPE < self.min_slope:
+            raise ValueError('AP_SLOPE %g is below the table minimum %g'
+                             % (AP_SLOPE, self.min_slope))
+        run = instrument.current()
+        with run.stage('dedup'):
+            keep = (self.steepness > AP_SLOPE) & (magnitude(self.amplitudes) > THRESHOLD)
+            peaks = np.unique(self.peaks[keep])
+        run.count('spikes accepted', len(peaks))
+        return peaks
+
+    def AP_finder(self, threshold_ratio=THRESHOLD_RATIO, slope_ratio=SLOPE_RATIO):
+        """
+        Returns the SpikeTrain good_AP_finder would return for these
+        settings (and the table's spread_time), from the table alone
+        """
+        THRESHOLD, AP_SLOPE, SPREAD = AP_constants(self.SAMPLING_RATE, *self.stats,
+                                                   threshold_ratio=threshold_ratio,
+                                                   slope_ratio=slope_ratio)
+        indices = self.select(THRESHOLD, AP_SLOPE)
+        # the voltage at each peak is already in the table
+        order = np.argsort(self.peaks, kind='mergesort')
+        amplitudes = self.amplitudes[order[np.searchsorted(self.peaks[order], indices)]]
+        amplitudes = np.asarray(amplitudes, dtype=np.float64) * self.gain
+        return SpikeTrain(indices, self.time, amplitudes, np.sign(amplitudes))
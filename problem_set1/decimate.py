@@ -0,0 +1,70 @@
+#
+#  NAME
+#    decimate.py
+#
+#  DESCRIPTION
+#    Reduces long traces to roughly one point pair per screen pixel for
+#    plotting.  minmax_envelope keeps the extremes of every pixel-wide bin,
+#    so spikes stay visible however far out the view is zoomed; lttb
+#    (Largest-Triangle-Three-Buckets) keeps the points that best preserve
+#    the shape of the line.
+#
+
+import numpy as np
+
+METHODS = ('minmax', 'lttb')
+
+def minmax_envelope(voltage, start, stop, n_bins):
+    """
+    Splits voltage[start:stop] into n_bins equal bins and returns
+    (indices, values) holding each bin's minimum then maximum, at the bin's
+    first sample index.  Ranges of at most 2 * n_bins samples are returned
+    as they are.
+    """
+    n = stop - start
+    if n <= 2 * n_bins:
+        return np.arange(start, stop), np.asarray(voltage[start:stop])
+    segment = np.asarray(voltage[start:stop])
+    edges = (np.arange(n_bins) * n) // n_bins
+    indices = np.repeat(edges + start, 2)
+    values = np.empty(2 * n_bins, dtype=segment.dtype)
+    values[0::2] = np.minimum.reduceat(segment, edges)
+    values[1::2] = np.maximum.reduceat(segment, edges)
+    return indices, values
+
+def lttb(voltage, start, stop, n_out):
+    """
+    Returns (indices, values) of n_out samples of voltage[start:stop] chosen
+    by Largest-Triangle-Three-Buckets: the first and last samples, plus from
+    each bucket in between the sample forming the largest triangle with the
+    previously chosen sample and the mean of the next bucket
+    """
+    n = stop - start
+    if n <= n_out or n_out < 3:
+        return np.arange(start, stop), np.asarray(voltage[start:stop])
+    segment = np.asarray(voltage[start:stop], dtype=np.float64)
+    edges = 1 + ((n - 2) * np.arange(n_out - 1)) // (n_out - 2)
+    chosen = np.empty(n_out, dtype=np.intp)
+    chosen[0] = 0
+    chosen[-1] = n - 1
+    # mean of every bucket, plus the last sample as a final "bucket"
+    means = np.append(np.add.reduceat(segment[1:n - 1], edges[:-1] - 1) / np.diff(edges),
+                      segment[-1])
+    centers = np.append((edges[:-1] + edges[1:] - 1) / 2.0, n - 1)
+    previous = 0
+    for bucket in range(n_out - 2):
+        low, high = edges[bucket], edges[bucket + 1]
+        x = np.arange(low, high)
+        area = np.abs((previous - centers[bucket + 1]) * (segment[low:high] - segment[previous]) -
+                      (previous - x) * (means[bucket + 1] - segment[previous]))
+        previous = low + area.argmax()
+        chosen[bucket + 1] = previous
+    return chosen + start, segment[chosen]
+
+def decimate(voltage, start, stop, pixels, method='minmax'):
+    """Returns (indices, values) for drawing voltage[start:stop] pixels wide"""
+    if method == 'minmax':
+        return minmax_envelope(voltage, start, stop, pixels)
+    if method == 'lttb':
+        return lttb(voltage, start, stop, 2 * pixels)
+    raise ValueError('method must be one of %s, got %r' % (METHODS, method))
@@ -0,0 +1,139 @@
+#
+#  NAME
+#    filtering.py
+#
+#  DESCRIPTION
+#    Bandpass filtering ahead of spike detection.  Slow drift and LFP
+#    inflate the voltage's standard deviation and peak, and with them the
+#    detector's thresholds; removing everything outside the spike band
+#    (300-6000 Hz by default) first leaves far fewer false slope runs.
+#
+#    The filter is a linear-phase windowed-sinc FIR applied by FFT
+#    convolution and shifted back by its group delay, so spikes stay where
+#    they are.  It can run on
+#        - a whole array (bandpass),
+#        - any slice of a long recording, read lazily (BandpassView, which
+#          every block-streaming function accepts in place of the voltage),
+#        - blocks pushed in acquisition order (BandpassFilter), carrying
+#          the filter history from one block to the next.
+#    All three give the same samples.
+#
+
+import numpy as np
+
+LOW_HZ = 300.0
+HIGH_HZ = 6000.0
+# samples filtered per FFT by bandpass()
+BLOCK_SIZE = 1 << 20
+
+def bandpass_taps(sample_rate, low=LOW_HZ, high=HIGH_HZ, n_taps=None):
+    """
+    Returns the (odd) taps of a Hamming-windowed sinc bandpass filter
+    passing low to high Hz.  By default the filter is long enough for a
+    transition band of about low / 2.
+    """
+    nyquist = sample_rate / 2.0
+    if not 0 < low < min(high, nyquist):
+        raise ValueError('need 0 < low < high and low below %g Hz, got %r-%r'
+                         % (nyquist, low, high))
+    if n_taps is None:
+        n_taps = int(3.3 * sample_rate / (low / 2.0))
+    n_taps += 1 - n_taps % 2
+    n = np.arange(n_taps) - (n_taps - 1) // 2
+
+    def lowpass(cutoff):
+        return 2.0 * cutoff / sample_rate * np.sinc(2.0 * cutoff / sample_rate * n)
+    return (lowpass(min(high, nyquist)) - lowpass(low)) * np.hamming(n_taps)
+
+def convolve_valid(samples, taps):
+    """Returns np.convolve(samples, taps, 'valid'), computed by FFT"""
+    size = len(samples) + len(taps) - 1
+    nfft = 1 << int(np.ceil(np.log2(size)))
+    spectrum = np.fft.rfft(samples, nfft) * np.fft.rfft(taps, nfft)
+    return np.fft.irfft(spectrum, nfft)[len(taps) - 1:len(samples)]
+
+class BandpassView(object):
+    """
+    Read-only view of voltage through a bandpass filter.  Slicing returns
+    the filtered samples of that range, reading only the range plus half the
+    filter length on each side, so block-by-block code (streaming.py,
+    multichannel.py) can filter recordings larger than memory.  Samples
+    before the start and after the end are taken as zero.
+    """
+
+    ndim = 1
+
+    def __init__(self, voltage, sample_rate, low=LOW_HZ, high=HIGH_HZ, taps=None):
+        self.voltage = voltage
+        self.taps = bandpass_taps(sample_rate, low, high) if taps is None else np.asarray(taps)
+        self.delay = (len(self.taps) - 1) // 2
+
+    def __len__(self):
+        return len(self.voltage)
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float64)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError('BandpassView only supports contiguous slices')
+        start, stop, step = key.indices(len(self))
+        if stop <= start:
+            return np.array([], dtype=np.float64)
+        # the output at i needs input i - delay ... i + delay
+        low, high = start - self.delay, stop + self.delay
+        samples = np.zeros(high - low)
+        read_low, read_high = max(0, low), min(len(self.voltage), high)
+        samples[read_low - low:read_high - low] = self.voltage[read_low:read_high]
+        return convolve_valid(samples, self.taps)
+
+    def __array__(self, dtype=None):
+        return np.asarray(bandpass_blocks(self), dtype=dtype)
+
+def bandpass_blocks(view, block_size=BLOCK_SIZE):
+    """Returns the whole of a BandpassView, filtered block_size samples at a time"""
+    filtered = np.empty(len(view))
+    for start in range(0, len(view), block_size):
+        stop = min(start + block_size, len(view))
+        filtered[start:stop] = view[start:stop]
+    return filtered
+
+def bandpass(voltage, sample_rate, low=LOW_HZ, high=HIGH_HZ):
+    """Returns voltage (a vector) filtered to low-high Hz"""
+    return bandpass_blocks(BandpassView(voltage, sample_rate, low, high))
+
+class BandpassFilter(object):
+    """
+    Bandpass filter for blocks pushed in order (e.g. from acquisition or
+    ahead of online.OnlineAPDetector).  push() returns as many filtered
+    samples as the filter's look-ahead allows - the output lags the input by
+    the filter's group delay - and flush() returns the rest at the end.
+    """
+
+    def __init__(self, sample_rate, low=LOW_HZ, high=HIGH_HZ, taps=None):
+        self.taps = bandpass_taps(sample_rate, low, high) if taps is None else np.asarray(taps)
+        self.delay = (len(self.taps) - 1) // 2
+        # the last len(taps) - 1 inputs; zeros stand for the time before the start
+        self._history = np.zeros(len(self.taps) - 1)
+        # convolution outputs still to drop to undo the delay
+        self._skip = self.delay
+
+    def push(self, samples):
+        samples = np.asarray(samples, dtype=np.float64).ravel()
+        if len(samples) == 0:
+            return samples
+        buffered = np.concatenate([self._history, samples])
+        self._history = buffered[len(buffered) - len(self._history):]
+        filtered = convolve_valid(buffered, self.taps)
+        skipped = min(self._skip, len(filtered))
+        self._skip -= skipped
+        return filtered[skipped:]
+
+    def flush(self):
+        """Returns the last delay samples, taking the input as zero from here on"""
+        return self.push(np.zeros(self.delay))
@@ -0,0 +1,133 @@
+#
+#  NAME
+#    instrument.py
+#
+#  DESCRIPTION
+#    Stage timers and counters for the detection pipeline.  Instrumentation
+#    is off by default: the pipeline then talks to a null recorder whose
+#    methods do nothing, so the cost is one function call per stage, not per
+#    sample.  Turn it on around a run and export what it collected:
+#
+#        with instrument.instrumented(dataset='spikes_easy_test') as run:
+#            good_AP_finder(t, v)
+#        print run.as_dict()
+#        run.write_json_line(open('runs.jsonl', 'a'))
+#
+
+import json
+import time as wallclock
+from contextlib import contextmanager
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class NullInstrumentation(object):
+    """Recorder used while instrumentation is off; every method is a no-op"""
+
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def count(self, name, n=1):
+        pass
+
+    def record(self, name, value):
+        pass
+
+class _Stage(object):
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+
+    def __enter__(self):
+        self.began = wallclock.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timer = self.run.timers.setdefault(self.name, [0.0, 0])
+        timer[0] += wallclock.time() - self.began
+        timer[1] += 1
+        return False
+
+class Instrumentation(object):
+    """
+    Collects, for one run:
+        timers - total seconds and number of calls per named stage
+        counters - named running totals
+        values - named settings or results (the last value recorded wins)
+        labels - whatever describes the run (dataset, parameters, ...)
+    """
+
+    enabled = True
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.timers = {}
+        self.counters = {}
+        self.values = {}
+
+    def stage(self, name):
+        """Returns a context manager that adds its duration to timer name"""
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, value):
+        self.values[name] = value
+
+    def dominant_stage(self):
+        """Returns the name of the stage that took the most time, or None"""
+        if not self.timers:
+            return None
+        return max(self.timers, key=lambda name: self.timers[name][0])
+
+    def as_dict(self):
+        return {'labels': dict(self.labels),
+                'timers': dict((name, {'seconds': seconds, 'calls': calls})
+                               for name, (seconds, calls) in self.timers.items()),
+                'counters': dict(self.counters),
+                'values': dict(self.values)}
+
+    def write_json_line(self, f):
+        """Appends this run to f as one line of JSON"""
+        record = self.as_dict()
+        record['timestamp'] = wallclock.strftime('%Y-%m-%dT%H:%M:%S')
+        f.write(json.dumps(record, sort_keys=True, default=float) + '\n')
+
+_NULL = NullInstrumentation()
+_current = _NULL
+
+def current():
+    """Returns the active recorder (a NullInstrumentation when off)"""
+    return _current
+
+def enable(**labels):
+    """Starts recording into a new Instrumentation and returns it"""
+    global _current
+    _current = Instrumentation(**labels)
+    return _current
+
+def disable():
+    """Stops recording; returns the Instrumentation that was active"""
+    global _current
+    previous, _current = _current, _NULL
+    return previous
+
+@contextmanager
+def instrumented(**labels):
+    """Records the enclosed run into a new Instrumentation, which it yields"""
+    global _current
+    previous = _current
+    run = enable(**labels)
+    try:
+        yield run
+    finally:
+        _current = previous
@@ -0,0 +1,89 @@
+#
+#  NAME
+#    jit_kernels.py
+#
+#  DESCRIPTION
+#    The detection kernels of backends.py as plain loops compiled by numba:
+#    one pass over the samples for the steep slope runs, and a walk outward
+#    from each center for its peak, with no temporaries the size of the
+#    recording or of the peak windows.  They follow NumpyBackend exactly,
+#    ties and clipped windows included.  Compiled code is cached on disk
+#    (next to this file, or in NUMBA_CACHE_DIR if that is not writable), one
+#    version per sample type.
+#
+#    Importing this module imports numba; backends.py only does so when the
+#    numba backend is asked for.
+#
+
+import numba
+import numpy as np
+
+@numba.njit(cache=True, nogil=True)
+def steep_runs(voltage, AP_SLOPE):
+    """
+    Returns the index i of every run of three consecutive slopes steeper
+    than AP_SLOPE (see problem_set1.find_steep_runs)
+    """
+    runs = np.empty(1024, dtype=np.intp)
+    count = 0
+    streak = 0
+    for i in range(len(voltage) - 1):
+        # the larger sample minus the smaller, so unsigned samples cannot
+        # wrap around; it is the same difference numpy rounds for floats
+        if voltage[i + 1] >= voltage[i]:
+            slope = voltage[i + 1] - voltage[i]
+        else:
+            slope = voltage[i] - voltage[i + 1]
+        if slope > AP_SLOPE:
+            streak += 1
+            if streak >= 3:
+                if count == len(runs):
+                    grown = np.empty(2 * len(runs), dtype=np.intp)
+                    grown[:count] = runs
+                    runs = grown
+                runs[count] = i - 2
+                count += 1
+        else:
+            streak = 0
+    return runs[:count].copy()
+
+@numba.njit(cache=True, nogil=True)
+def _clip(i, last):
+    return min(max(i, 0), last)
+
+@numba.njit(cache=True, nogil=True)
+def refine_peaks(voltage, centers, SPREAD):
+    """
+    Returns the index of the largest excursion within SPREAD samples of
+    each center, nearest the center (left first) on ties (see
+    problem_set1.refine_peaks)
+    """
+    last = len(voltage) - 1
+    peaks = np.empty(len(centers), dtype=np.intp)
+    for k in range(len(centers)):
+        center = centers[k]
+        low_index = _clip(center - SPREAD, last)
+        high = voltage[low_index]
+        low = voltage[low_index]
+        for i in range(low_index + 1, _clip(center + SPREAD, last) + 1):
+            if voltage[i] > high:
+                high = voltage[i]
+            if voltage[i] < low:
+                low = voltage[i]
+        # compared as float64, exact for every sample type up to 32 bits
+        if abs(np.float64(high)) > abs(np.float64(low)):
+            peak = high
+        else:
+            peak = low
+        # the peak is one of the window's samples, so this only stays for NaN
+        peaks[k] = low_index
+        for distance in range(SPREAD + 1):
+            i = _clip(center - distance, last)
+            if voltage[i] == peak:
+                peaks[k] = i
+                break
+            i = _clip(center + distance, last)
+            if voltage[i] == peak:
+                peaks[k] = i
+                break
+    return peaks
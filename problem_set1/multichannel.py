@@ -0,0 +1,116 @@
+#
+#  NAME
+#    multichannel.py
+#
+#  DESCRIPTION
+#    Spike detection on multi-channel recordings, one channel per task.
+#    Arrays already in memory (or memory-mapped) are shared by a pool of
+#    threads - the numpy kernels release the GIL - and recording files are
+#    shared by a pool of processes that each map the file themselves, so no
+#    samples are pickled between processes.  Every channel is detected block
+#    by block (see streaming.py), so a worker holds one block at a time
+#    rather than a whole channel.
+#
+
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from problem_set1 import AP_constants, detection_input
+from recording import open_recording, read_header, header_timebase, channel_ids
+from spiketrain import SpikeTrain
+from streaming import BLOCK_SIZE, stream_stats, stream_AP_indices
+
+# filename -> (header, samples), opened once per worker process
+_recordings = {}
+
+def channel_AP_indices(voltage, SAMPLING_RATE, block_size=BLOCK_SIZE, **params):
+    """
+    Returns the sorted action potential sample indices of one channel,
+    detected like good_AP_finder with the tuning in params
+    """
+    THRESHOLD, AP_SLOPE, SPREAD = AP_constants(SAMPLING_RATE,
+                                               *stream_stats(voltage, block_size),
+                                               **params)
+    blocks = list(stream_AP_indices(voltage, THRESHOLD, AP_SLOPE, SPREAD, block_size))
+    return np.concatenate(blocks) if blocks else np.array([], dtype=np.intp)
+
+def multichannel_AP_finder(time, voltage, channels=None, workers=None,
+                           block_size=BLOCK_SIZE, **params):
+    """
+    This function takes the following input:
+        time - vector of sample times in seconds, or a Timebase
+        voltage - channels x samples array (may be a memmap, or a
+            ScaledView from load_data, which is detected on its counts)
+        channels - ids of the channels to detect (default all); ids are
+            row numbers unless voltage came with other ids (see
+            recording_AP_finder)
+        workers - threads to use (default one per core)
+        block_size, params - passed on to channel_AP_indices
+
+    This function returns the following output:
+        APTimes - OrderedDict from channel id to that channel's SpikeTrain
+    """
+    # only spike indices are returned, so the counts need no scaling
+    voltage, gain, _ = detection_input(voltage)
+    voltage = np.asanyarray(voltage)
+    if voltage.ndim != 2 or voltage.shape[1] != len(time):
+        raise ValueError('voltage must be channels x %d samples, got shape %r'
+                         % (len(time), voltage.shape))
+    rows = range(len(voltage)) if channels is None else list(channels)
+    SAMPLING_RATE = time[1]-time[0]
+
+    def detect(row):
+        return channel_AP_indices(voltage[row], SAMPLING_RATE, block_size, **params)
+
+    pool = ThreadPool(workers or multiprocessing.cpu_count())
+    try:
+        indices = pool.map(detect, rows, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return OrderedDict((row, SpikeTrain(found, time)) for row, found in zip(rows, indices))
+
+def _open(filename):
+    if filename not in _recordings:
+        _recordings[filename] = open_recording(filename)
+    return _recordings[filename]
+
+def _detect_recording_channel(task):
+    filename, row, block_size, params = task
+    header, samples = _open(filename)
+    timebase = header_timebase(header)
+    return row, channel_AP_indices(samples[row], timebase[1]-timebase[0],
+                                   block_size, **params)
+
+def recording_AP_finder(filename, channels=None, processes=None,
+                        block_size=BLOCK_SIZE, **params):
+    """
+    Like multichannel_AP_finder, for a recording file (see recording.py),
+    across a pool of processes.  channels and the returned keys are the
+    file's channel ids.
+    """
+    header = read_header(filename)
+    timebase = header_timebase(header)
+    ids = channel_ids(header)
+    if channels is None:
+        rows = range(len(ids))
+    else:
+        missing = set(channels) - set(ids)
+        if missing:
+            raise ValueError('%s has no channels %s' % (filename, sorted(missing)))
+        rows = [ids.index(channel) for channel in channels]
+    tasks = [(filename, row, block_size, params) for row in rows]
+
+    if processes == 1:
+        results = [_detect_recording_channel(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_detect_recording_channel, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return OrderedDict((ids[row], SpikeTrain(found, timebase)) for row, found in results)
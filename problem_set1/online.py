@@ -0,0 +1,147 @@
+#
+#  NAME
+#    online.py
+#
+#  DESCRIPTION
+#    Real-time spike detection.  An OnlineAPDetector is fed blocks of
+#    samples as they are acquired and reports each spike as soon as the
+#    SPREAD samples after its slope run have arrived, keeping only running
+#    statistics and a carry-over buffer of a few SPREADs.
+#
+#    Because it cannot see the future, the detector derives THRESHOLD and
+#    AP_SLOPE from the samples seen so far (or takes them fixed), so its
+#    early output can differ from good_AP_finder on the whole recording.
+#
+#    The latency benchmark replays a recording in acquisition-sized blocks:
+#        python online.py spikes_easy_practice.npy [block_samples]
+#
+
+import sys
+import time as wallclock
+
+import numpy as np
+
+from problem_set1 import load_data, AP_constants, find_steep_runs, refine_peaks, \
+    THRESHOLD_RATIO, SLOPE_RATIO, SPREAD_TIME
+from streaming import RunningStats
+
+class OnlineAPDetector(object):
+    """
+    Incremental good_AP_finder.
+        SAMPLING_RATE - seconds between samples
+        start_time - time of the first sample pushed
+        THRESHOLD, AP_SLOPE - fixed detection constants; when None they
+            follow the running statistics like good_AP_finder's
+        threshold_ratio, slope_ratio, spread_time - detector tuning (see
+            problem_set1.AP_constants)
+    """
+
+    def __init__(self, SAMPLING_RATE, start_time=0.0, THRESHOLD=None, AP_SLOPE=None,
+                 threshold_ratio=THRESHOLD_RATIO, slope_ratio=SLOPE_RATIO,
+                 spread_time=SPREAD_TIME):
+        self.SAMPLING_RATE = SAMPLING_RATE
+        self.start_time = start_time
+        self.fixed_threshold = THRESHOLD
+        self.fixed_slope = AP_SLOPE
+        self.threshold_ratio = threshold_ratio
+        self.slope_ratio = slope_ratio
+        self.SPREAD = int(spread_time / SAMPLING_RATE)
+        self.stats = RunningStats()
+        self.n_samples = 0
+        # buffer holds samples [buffer_start, n_samples)
+        self._buffer = np.array([], dtype=np.float64)
+        self._buffer_start = 0
+        # first slope run that has not been scanned yet
+        self._next_run = 0
+        # emitted peaks a later run could still find again
+        self._recent = np.array([], dtype=np.intp)
+
+    def constants(self):
+        """Returns the (THRESHOLD, AP_SLOPE) currently in use"""
+        THRESHOLD, AP_SLOPE, SPREAD = AP_constants(
+            self.SAMPLING_RATE, self.stats.max, self.stats.min, self.stats.std,
+            self.threshold_ratio, self.slope_ratio)
+        if self.fixed_threshold is not None:
+            THRESHOLD = self.fixed_threshold
+        if self.fixed_slope is not None:
+            AP_SLOPE = self.fixed_slope
+        return THRESHOLD, AP_SLOPE
+
+    def push(self, samples):
+        """
+        Adds the next block of samples and returns the sample indices
+        (counted from the first sample pushed) of the spikes whose windows
+        it completed, in increasing order
+        """
+        samples = np.asarray(samples, dtype=np.float64).ravel()
+        if self.fixed_threshold is None or self.fixed_slope is None:
+            self.stats.update(samples)
+        self._buffer = np.concatenate([self._buffer, samples])
+        self.n_samples += len(samples)
+
+        # a run starting at i is final once sample i+2+SPREAD has arrived
+        last_run = self.n_samples - 3 - self.SPREAD
+        if last_run < self._next_run:
+            return np.array([], dtype=np.intp)
+        THRESHOLD, AP_SLOPE = self.constants()
+
+        offset = self._buffer_start
+        runs = find_steep_runs(self._buffer[self._next_run - offset:last_run + 4 - offset],
+                               AP_SLOPE) + self._next_run - offset
+        peaks = refine_peaks(self._buffer, runs + 2, self.SPREAD)
+        peaks = peaks[np.abs(self._buffer[peaks]) > THRESHOLD] + offset
+        peaks = np.setdiff1d(np.unique(peaks), self._recent)
+
+        self._next_run = last_run + 1
+        # keep what the next runs and their peak windows can reach
+        keep = max(0, min(self._next_run, self._next_run + 2 - self.SPREAD))
+        self._buffer = self._buffer[keep - offset:]
+        self._buffer_start = keep
+        self._recent = np.union1d(self._recent, peaks)
+        self._recent = self._recent[self._recent >= self._next_run + 2 - self.SPREAD]
+        return peaks
+
+    def times(self, indices):
+        """Returns the times in seconds of sample indices returned by push"""
+        return self.start_time + np.asarray(indices) * self.SAMPLING_RATE
+
+def latency_benchmark(time, voltage, block_samples=32, **params):
+    """
+    Replays voltage through an OnlineAPDetector in blocks of block_samples
+    and measures, for each spike, the time from the arrival of its peak
+    sample to its emission: the wait for the rest of the window to be
+    acquired plus the time push took to process the block that completed
+    it.  Returns a dict with the spike count, the p50, p99 and max latency
+    in milliseconds, and the mean push time in microseconds.
+    """
+    SAMPLING_RATE = time[1]-time[0]
+    detector = OnlineAPDetector(SAMPLING_RATE, time[0], **params)
+    latencies = []
+    push_times = []
+    for start in range(0, len(voltage), block_samples):
+        block = np.asarray(voltage[start:start + block_samples])
+        stop = start + len(block)
+        began = wallclock.time()
+        peaks = detector.push(block)
+        elapsed = wallclock.time() - began
+        push_times.append(elapsed)
+        # a sample arrives when the block holding it has been acquired
+        arrived = (peaks // block_samples + 1) * block_samples
+        latencies.extend((stop - arrived) * SAMPLING_RATE + elapsed)
+    latencies = np.array(latencies) * 1000.0
+    return {'spikes': len(latencies),
+            'block ms': block_samples * SAMPLING_RATE * 1000.0,
+            'p50 ms': np.percentile(latencies, 50) if len(latencies) else np.nan,
+            'p99 ms': np.percentile(latencies, 99) if len(latencies) else np.nan,
+            'max ms': latencies.max() if len(latencies) else np.nan,
+            'mean push us': np.mean(push_times) * 1e6}
+
+if __name__ == "__main__":
+    t, v = load_data(sys.argv[1])
+    result = latency_benchmark(t, v, int(sys.argv[2]) if len(sys.argv) > 2 else 32)
+    print 'Online detector latency (%.0f Hz, %.2f ms blocks):' % (1.0 / (t[1]-t[0]), result['block ms'])
+    print '   spikes:     %d' % result['spikes']
+    print '   p50:        %.3f ms' % result['p50 ms']
+    print '   p99:        %.3f ms' % result['p99 ms']
+    print '   max:        %.3f ms' % result['max ms']
+    print '   mean push:  %.1f us' % result['mean push us']
@@ -6,19 +6,75 @@
 #    Open, view, and analyze raw extracellular data
 #    In Problem Set 1, you will write create and test your own spike detector.
 #
+#    Loading, detection and scoring only need numpy; matplotlib is imported
+#    the first time something is plotted, so headless scripts and workers
+#    never pay for it.
+#
+
+from collections import namedtuple
 
 import numpy as np
-import matplotlib.pylab as plt
 
-def load_data(filename):
+import backends
+import filtering
+import instrument
+import recording
+from recording import Timebase
+from waveforms import extract_waveforms
+from decimate import decimate
+from spiketrain import SpikeTrain, spike_indices
+# the detector works in the voltage's own type, widening integer counts
+from backends import magnitude
+
+def _pylab():
+    """Returns matplotlib.pylab, importing it on first use"""
+    import matplotlib.pylab
+    return matplotlib.pylab
+
+def load_data(filename, multichannel=False, counts=False):
     """
     load_data takes the file name and reads in the data.  It returns two 
     arrays of data, the first containing the time stamps for when they data
     were recorded (in units of seconds), and the second containing the 
     corresponding voltages recorded (in units of microvolts - uV)
+
+    filename may be a recording file (see recording.py), whose samples are
+    a read-only memmap, or a legacy spikes_*.npy dict file.
+    Uniformly sampled time stamps come back as a Timebase, which indexes
+    like the time array without storing it.
+
+    Multi-channel recordings return voltage as a channels x samples array.
+    Single-channel recordings return a vector, unless multichannel is True,
+    in which case they are returned as a 1 x samples array too.
+
+    Recordings stored as integer ADC counts return voltage as a
+    recording.ScaledView of the memmap: float32 voltage, scaled only as it
+    is indexed, so nothing is read or copied up front.  good_AP_finder and
+    the other detectors run on its counts directly.  With counts=True the
+    samples are returned as stored instead (the memmap itself), along with
+    a third value, the gain (voltage per count) of each channel.
     """
-    data = np.load(filename)[()];
-    return np.array(data['time']), np.array(data['voltage'])
+    if recording.is_recording(filename):
+        header, samples = recording.open_recording(filename)
+        time = recording.header_timebase(header)
+        gain = recording.header_gain(header)
+        voltage = samples
+    else:
+        data = np.load(filename, allow_pickle=True)[()];
+        time = np.asarray(data['time'])
+        time = Timebase.from_times(time) or time
+        voltage = np.asarray(data['voltage'])
+        gain = np.ones(1 if voltage.ndim == 1 else len(voltage))
+    if voltage.ndim == 1 and multichannel:
+        voltage = voltage[np.newaxis, :]
+    elif voltage.ndim == 2 and len(voltage) == 1 and not multichannel:
+        voltage = voltage[0]
+        gain = gain[0]
+    if counts:
+        return time, voltage, gain
+    if voltage.dtype.kind in 'iu':
+        voltage = recording.ScaledView(voltage, gain)
+    return time, voltage
     
 def bad_AP_finder(time,voltage):
     """
@@ -57,11 +113,169 @@ def bad_AP_finder(time,voltage):
     
     return APTimes
     
-def good_AP_finder(time,voltage):
+def detection_input(voltage, gain=None, stats=None):
+    """
+    Returns (voltage, gain, stats) to detect on: for a recording.ScaledView
+    its counts and gain, with stats (in volts) converted to counts, and
+    anything else as given.  The gain of a channels x samples view is the
+    vector of its channels' gains; stats, which belong to one channel,
+    cannot be given with one (ValueError).
+    """
+    if isinstance(voltage, recording.ScaledView):
+        if voltage.ndim == 2:
+            if stats is not None:
+                raise ValueError('stats are for one channel, got a %d-channel view'
+                                 % len(voltage))
+            gain = np.asarray(voltage.gain, dtype=np.float64)
+        else:
+            gain = float(voltage.gain)
+            if stats is not None:
+                stats = tuple(value / gain for value in stats)
+        voltage = voltage.counts
+    return voltage, gain, stats
+
+# samples per block of the standard deviation (see voltage_std)
+STD_BLOCK = 1024
+# samples converted to float64 at once by voltage_std
+STD_CHUNK = STD_BLOCK << 10
+
+def block_moments(values, block_size=STD_BLOCK):
+    """
+    Returns (counts, sums, squares): the number of samples, their sum and
+    their sum of squared deviations from the block's mean, for every
+    block_size samples of values, in float64
+    """
+    # a fresh buffer, so the sums round alike wherever the samples come from
+    values = np.array(values, dtype=np.float64)
+    edges = np.arange(0, len(values), block_size)
+    counts = np.diff(np.append(edges, len(values))).astype(np.float64)
+    sums = np.add.reduceat(values, edges)
+    deviations = values - np.repeat(sums / counts, counts.astype(np.intp))
+    return counts, sums, np.add.reduceat(deviations * deviations, edges)
+
+def moments_std(counts, sums, squares):
+    """
+    Returns the standard deviation of all the samples of the blocks
+    described by block_moments, combined pairwise (Chan et al.)
+    """
+    total = counts.sum()
+    if total == 0:
+        raise ValueError('cannot compute statistics of an empty recording')
+    spread = sums / counts - sums.sum() / total
+    return float(np.sqrt((squares.sum() + np.dot(counts * spread, spread)) / total))
+
+def voltage_std(voltage, chunk=STD_CHUNK):
+    """
+    Returns the standard deviation of voltage (np.std to rounding), put
+    together from the block_moments of every STD_BLOCK samples, chunk
+    samples at a time.  streaming.stream_stats and pyramid.Pyramid.stats
+    use the same blocks and moments_std, so good_AP_finder, stream_AP_finder
+    and batch.py get the same value to the last bit.
+    """
+    chunk = max(STD_BLOCK, chunk - chunk % STD_BLOCK)
+    moments = [block_moments(voltage[start:start + chunk])
+               for start in range(0, len(voltage), chunk)]
+    if not moments:
+        raise ValueError('cannot compute statistics of an empty recording')
+    return moments_std(*[np.concatenate(column) for column in zip(*moments)])
+
+def find_steep_runs(voltage, AP_SLOPE):
+    """
+    Returns the index i of every run of three consecutive slopes
+    (voltage[i+1]-voltage[i], ... voltage[i+3]-voltage[i+2]) that are all
+    steeper than AP_SLOPE.  The scan runs on the current backend (see
+    backends.py).
+    """
+    run = instrument.current()
+    with run.stage('slope scan'):
+        runs = backends.current().find_steep_runs(voltage, AP_SLOPE)
+    run.count('candidates examined', len(runs))
+    return runs
+
+def refine_peaks(voltage, centers, SPREAD):
+    """
+    For each index in centers, returns the index of the largest excursion
+    (positive or negative) within SPREAD samples of it.  When the peak value
+    occurs more than once the occurrence nearest the center wins, and on a
+    tie the earlier one.  Windows are clipped at the ends of the recording.
+    The refinement runs on the current backend (see backends.py).
+    """
+    with instrument.current().stage('peak refinement'):
+        return backends.current().refine_peaks(voltage, centers, SPREAD)
+
+def AP_indices(voltage, THRESHOLD, AP_SLOPE, SPREAD):
+    """
+    Returns the sorted, unique sample indices of the action potentials in
+    voltage.  A spike is the local peak (within SPREAD samples) around a run
+    of three steep slopes whose absolute voltage is above THRESHOLD.
+    """
+    # find local max near the second slope of each run
+    # b/c it's more likely to be closer to the peak
+    peaks = refine_peaks(voltage, find_steep_runs(voltage, AP_SLOPE) + 2, SPREAD)
+    run = instrument.current()
+    with run.stage('dedup'):
+        peaks = peaks[magnitude(voltage[peaks]) > THRESHOLD]
+        # unique prevents duplicates
+        peaks = np.unique(peaks)
+    run.count('spikes accepted', len(peaks))
+    return peaks
+
+# Default detector tuning
+THRESHOLD_RATIO = 0.5  # THRESHOLD as a fraction of the absolute peak voltage
+SLOPE_RATIO = 2.0      # AP_SLOPE in standard deviations of the voltage
+SPREAD_TIME = .0008    # SPREAD in seconds
+
+def AP_constants(SAMPLING_RATE, max_voltage, min_voltage, std_voltage,
+                 threshold_ratio=THRESHOLD_RATIO, slope_ratio=SLOPE_RATIO,
+                 spread_time=SPREAD_TIME):
+    """
+    Returns the detection constants (THRESHOLD, AP_SLOPE, SPREAD) for a
+    recording with the given sample spacing (in seconds) and voltage
+    statistics.  Splitting these out lets the statistics come from a single
+    pass over the whole array or be accumulated block by block.
+    """
+    peak_voltage = max_voltage if abs(max_voltage) > abs(min_voltage) else min_voltage
+    THRESHOLD = abs(peak_voltage) * threshold_ratio
+    AP_SLOPE = std_voltage * slope_ratio
+    SPREAD = int(spread_time / SAMPLING_RATE) # number of samples in spread_time
+    return THRESHOLD, AP_SLOPE, SPREAD
+
+def print_AP_constants(THRESHOLD, SAMPLING_RATE, AP_SLOPE, SPREAD):
+    print 'Calculating good APs: '
+    print '   THRESHOLD:     %f' % THRESHOLD
+    print '   SAMPLING_RATE: %f' % SAMPLING_RATE
+    print '   SLOPE:         %d' % AP_SLOPE
+    print '   SPREAD:        %d' % SPREAD     
+
+def record_AP_constants(THRESHOLD, SAMPLING_RATE, AP_SLOPE, SPREAD, verbose=False):
+    """Records the detection constants with the instrumentation (and prints them if verbose)"""
+    run = instrument.current()
+    run.record('THRESHOLD', THRESHOLD)
+    run.record('SAMPLING_RATE', SAMPLING_RATE)
+    run.record('AP_SLOPE', AP_SLOPE)
+    run.record('SPREAD', SPREAD)
+    if verbose:
+        print_AP_constants(THRESHOLD, SAMPLING_RATE, AP_SLOPE, SPREAD)
+
+def good_AP_finder(time, voltage, threshold_ratio=THRESHOLD_RATIO,
+                   slope_ratio=SLOPE_RATIO, spread_time=SPREAD_TIME, band=None,
+                   verbose=False, gain=None, stats=None):
     """
     This function takes the following input:
-        time - vector where each element is a time in seconds
+        time - vector where each element is a time in seconds, or a Timebase
         voltage - vector where each element is a voltage at a different time
+            (a ScaledView from load_data is detected on its counts)
+        threshold_ratio, slope_ratio, spread_time - detector tuning (see
+            AP_constants)
+        band - optional (low, high) Hz to bandpass filter the voltage to
+            before detecting (see filtering.py)
+        verbose - print the detection constants and spike count
+        gain - voltage per count, when voltage is integer ADC counts (see
+            load_data); detection runs on the counts and only the spike
+            amplitudes are scaled
+        stats - optional (max, min, std) of voltage, e.g. from the
+            recording's summary pyramid (see pyramid.py), to use instead of
+            scanning it; ignored when band is given
         
         We are assuming that the two vectors are in correspondance (meaning
         that at a given index, the time in one corresponds to the voltage in
@@ -69,72 +283,46 @@ def good_AP_finder(time,voltage):
         won't run
     
     This function returns the following output:
-        APTimes - all the times where a spike (action potential) was detected
+        APTimes - a SpikeTrain of all the spikes (action potentials) that
+            were detected, in increasing order.  It can be used like the list
+            of their times, and also holds their sample indices, amplitudes
+            and polarity.
     """
-#    def get_absolute_peak(arr):
-#        """Return the value of the highest value in the array"""
-#        return max(arr) if abs(max(arr)) > abs(min(arr)) else min(arr)
- 
-    # Constants
-    peak_voltage = max(voltage) if abs(max(voltage)) > abs(min(voltage)) else min(voltage)
-#    THRESHOLD = abs(get_absolute_peak(voltage)) / 2.0
-    THRESHOLD = abs(peak_voltage) / 2.0
-    SAMPLING_RATE = time[1]-time[0]  
-    AP_SLOPE = np.std(voltage) * 2 
-    SPREAD = int(.0008 / SAMPLING_RATE) # number of samples in 1 ms
-    
-    print 'Calculating good APs: '
-    print '   THRESHOLD:     %f' % THRESHOLD
-    print '   SAMPLING_RATE: %f' % SAMPLING_RATE
-    print '   SLOPE:         %d' % AP_SLOPE
-    print '   SPREAD:        %d' % SPREAD     
-    
-    # Data stores
-    APTimes = []
-    AP_set = set()
-
-    # for seeing steep changes in voltage
-    voltage_delta = np.diff(voltage)     
-       
     #Let's make sure the input looks at least reasonable
     if (len(voltage) != len(time)):
         print "Can't run - the vectors aren't the same length!"
-        return APTimes
-        
-#    def find_local_peak(index):
-#        """
-#        Return local peak (either a spike or valley) index. 
-#        (Local is within a .002s spread)
-#        """
-#        sample = voltage[index-SPREAD:index+SPREAD+1]
-#        # now find the biggest spike (neg or positive)
-#        local_peak = get_absolute_peak(sample)
-#        
-#        # note: sorting idea came from http://stackoverflow.com/a/12141207
-#        peak_index = min(plt.find(voltage==local_peak), key=lambda x:abs(x-index))
-#        return peak_index
-
-    # Use steep slopes to find local peaks and valleys
-    for i, v in enumerate(voltage_delta):
-        # Check for a string of slopes above threshold
-        if abs(v) > AP_SLOPE and abs(voltage_delta[i+1]) > AP_SLOPE and abs(voltage_delta[i+2]) > AP_SLOPE:
-            # find local max near the second one 
-            # b/c it's more likely to be closer to the peak
-#            local_peak = find_local_peak(i+2)
-            # testing removal of inner fcn
-            i2 = i+2
-            sample = voltage[i2-SPREAD:i2+SPREAD+1]
-            local_peak = max(sample) if abs(max(sample)) > abs(min(sample)) else min(sample)
-            # note: sorting idea came from http://stackoverflow.com/a/12141207
-            local_peak = min(plt.find(voltage==local_peak), key=lambda x:abs(x-i2))
-
-            if abs(voltage[local_peak]) > THRESHOLD:
-                # set prevents duplicates
-                AP_set.add(time[local_peak])
-                
-    APTimes = list(AP_set)
+        return []
+    if not isinstance(time, Timebase):
+        time = np.asarray(time)
+    voltage, gain, stats = detection_input(voltage, gain, stats)
+    voltage = np.asarray(voltage)
+
+    run = instrument.current()
+    run.count('samples processed', len(voltage))
+
+    # Constants
+    SAMPLING_RATE = time[1]-time[0]  
+    if band is not None:
+        with run.stage('filter'):
+            voltage = filtering.bandpass(voltage, 1.0 / SAMPLING_RATE, *band)
+    with run.stage('stats'):
+        if stats is not None and band is None:
+            max_voltage, min_voltage, std_voltage = stats
+        else:
+            max_voltage, min_voltage = float(voltage.max()), float(voltage.min())
+            std_voltage = voltage_std(voltage)
+    THRESHOLD, AP_SLOPE, SPREAD = AP_constants(SAMPLING_RATE, max_voltage,
+                                               min_voltage, std_voltage,
+                                               threshold_ratio, slope_ratio,
+                                               spread_time)
+    record_AP_constants(THRESHOLD, SAMPLING_RATE, AP_SLOPE, SPREAD, verbose)
+    
+    indices = AP_indices(voltage, THRESHOLD, AP_SLOPE, SPREAD)
+    amplitudes = np.asarray(voltage[indices], dtype=np.float64) * (1.0 if gain is None else gain)
+    APTimes = SpikeTrain(indices, time, amplitudes, np.sign(amplitudes))
     
-    print '# APs found: %d' % len(APTimes)
+    if verbose:
+        print '# APs found: %d' % len(APTimes)
     
     return APTimes
     
@@ -150,73 +338,175 @@ def get_actual_times(dataset):
     """    
     return np.load(dataset)
     
-def detector_tester(APTimes, actualTimes):
+SpikeMatch = namedtuple('SpikeMatch', ['detected', 'actual', 'missed', 'false'])
+
+def match_spikes(APTimes, actualTimes, JITTER=0.0025):
+    """
+    Matches detected spike times to actual spike times one to one.  Each
+    actual spike, in time order, takes the earliest detected spike within
+    JITTER seconds that no earlier actual spike has taken; repeated
+    detections of the same time can only be matched once.  Both lists are
+    walked once after sorting, so this is O(N log N) rather than O(N*M).
+
+    This function returns a SpikeMatch of index arrays into the inputs:
+        detected, actual - the matched pairs (detected[k] goes with actual[k])
+        missed - actual spikes with no detection
+        false - detections that matched nothing
+    """
+    APTimes = np.asarray(APTimes, dtype=np.float64)
+    actualTimes = np.asarray(actualTimes, dtype=np.float64)
+    detected_order = np.argsort(APTimes, kind='mergesort')
+    actual_order = np.argsort(actualTimes, kind='mergesort')
+    detected = APTimes[detected_order]
+    actual = actualTimes[actual_order]
+
+    #remove spikes with the same times (these are false APs)
+    first = np.ones(len(detected), dtype=bool)
+    first[1:] = detected[1:] != detected[:-1]
+    unique = np.flatnonzero(first)
+
+    # window of candidate detections for every actual spike
+    low = np.searchsorted(detected[unique], actual - JITTER, 'left').tolist()
+    high = np.searchsorted(detected[unique], actual + JITTER, 'right').tolist()
+
+    # detections taken by earlier spikes always precede the free ones in a
+    # window, so a single pointer tracks the first free detection
+    pairs = []
+    free = 0
+    for k in range(len(actual)):
+        j = max(low[k], free)
+        if j < high[k]:
+            pairs.append((j, k))
+            free = j + 1
+    pairs = np.array(pairs, dtype=np.intp).reshape(-1, 2)
+
+    matched_detected = detected_order[unique[pairs[:, 0]]]
+    matched_actual = actual_order[pairs[:, 1]]
+    missed = np.ones(len(actual), dtype=bool)
+    missed[pairs[:, 1]] = False
+    false = np.ones(len(detected), dtype=bool)
+    false[unique[pairs[:, 0]]] = False
+    return SpikeMatch(matched_detected, matched_actual,
+                      actual_order[missed], detected_order[false])
+
+def score_detector(APTimes, actualTimes, JITTER=0.0025):
+    """
+    returns percentTrueSpikes (% correct detected) and falseSpikeRate
+    (extra APs per second of data), like detector_tester but quietly
+    """
+    
+    run = instrument.current()
+    with run.stage('scoring'):
+        #first match the two sets of spike times. Anything within JITTER_MS
+        #is considered a match (but only one per time frame!)
+        match = match_spikes(APTimes, actualTimes, JITTER)
+        trueDetects = match.detected
+        actual = np.sort(actualTimes)
+        percentTrueSpikes = 100.0*len(trueDetects)/len(actualTimes)
+        
+        
+        #everything else is a false alarm
+        totalTime = (actual[len(actual)-1]-actual[0])
+        falseSpikeRate = (len(APTimes) - len(actualTimes))/totalTime
+    run.count('spikes matched', len(trueDetects))
+    run.count('spikes missed', len(match.missed))
+    run.count('false detections', len(match.false))
+    
+    return {'Percent True Spikes':percentTrueSpikes, 'False Spike Rate':falseSpikeRate}
+
+def detector_tester(APTimes, actualTimes, verbose=True):
     """
     returns percentTrueSpikes (% correct detected) and falseSpikeRate
     (extra APs per second of data)
-    compares actual spikes times with detected spike times
+    compares actual spikes times with detected spike times, and prints the
+    evaluation unless verbose is False
     This only works if we give you the answers!
     """
     
     JITTER = 0.0025 #2 ms of jitter allowed
     
-    #first match the two sets of spike times. Anything within JITTER_MS
-    #is considered a match (but only one per time frame!)
-    
-    #order the lists
-    detected = np.sort(APTimes)
-    actual = np.sort(actualTimes)
-    
-    #remove spikes with the same times (these are false APs)
-    temp = np.append(detected, -1)
-    detected = detected[plt.find(plt.diff(temp) != 0)]
- 
-    #find matching action potentials and mark as matched (trueDetects)
-    trueDetects = [];
-    for sp in actual:
-        z = plt.find((detected >= sp-JITTER) & (detected <= sp+JITTER))
-        if len(z)>0:
-            for i in z:
-                zz = plt.find(trueDetects == detected[i])
-                if len(zz) == 0:
-                    trueDetects = np.append(trueDetects, detected[i])
-                    break;
-    percentTrueSpikes = 100.0*len(trueDetects)/len(actualTimes)
-    
-    
-    #everything else is a false alarm
-    totalTime = (actual[len(actual)-1]-actual[0])
-    falseSpikeRate = (len(APTimes) - len(actualTimes))/totalTime
+    score = score_detector(APTimes, actualTimes, JITTER)
+    percentTrueSpikes = score['Percent True Spikes']
+    falseSpikeRate = score['False Spike Rate']
     
     # Added this for auto-evaluation based on criteria 
     pct_spike_eval = "PASS" if percentTrueSpikes > 90.0 else "FAIL"
     false_spike_eval = "PASS" if falseSpikeRate < 2.5 else "FAIL"
     overall_result = "FAIL" if pct_spike_eval == "FAIL" or false_spike_eval == "FAIL" else "PASS"    
+    instrument.current().record('evaluation', overall_result)
     
-    print 'Action Potential Detector Performance performance: '
-    print '     Correct number of action potentials = %d' % len(actualTimes)
-    print '     %s: Percent True Spikes = %f' % (pct_spike_eval, percentTrueSpikes)
-    print '     %s: False Spike Rate = %f spikes/s' % (false_spike_eval, falseSpikeRate)
-    print ''
-    print 'Overall Evaluation: %s' % overall_result
-    print ''
-    return {'Percent True Spikes':percentTrueSpikes, 'False Spike Rate':falseSpikeRate}
+    if verbose:
+        print 'Action Potential Detector Performance performance: '
+        print '     Correct number of action potentials = %d' % len(actualTimes)
+        print '     %s: Percent True Spikes = %f' % (pct_spike_eval, percentTrueSpikes)
+        print '     %s: False Spike Rate = %f spikes/s' % (false_spike_eval, falseSpikeRate)
+        print ''
+        print 'Overall Evaluation: %s' % overall_result
+        print ''
+    return score
     
     
-def plot_spikes(time, voltage, APTimes, titlestr):
+class DecimatedTrace(object):
+    """
+    A line on ax showing voltage against time, reduced to about one min/max
+    pair per pixel of the visible range (see decimate.py).  The reduction is
+    redone whenever the x limits change, so zooming in brings back the
+    samples of the new range.  Given the recording's summary pyramid, the
+    'minmax' envelope of a wide range is read from it instead of the samples.
+    """
+
+    def __init__(self, ax, time, voltage, method='minmax', summary=None, **style):
+        self.ax = ax
+        self.time = time
+        self.voltage = voltage
+        self.method = method
+        self.summary = summary
+        self.line, = ax.plot([], [], **style)
+        ax.set_xlim(time[0], time[len(time)-1])
+        ax.callbacks.connect('xlim_changed', self.update)
+        self.update(ax)
+        ax.relim()
+        ax.autoscale_view(scalex=False)
+
+    def update(self, ax):
+        low, high = ax.get_xlim()
+        start, stop = recording.time_index(self.time, [low, high])
+        start = max(0, start - 1)
+        stop = min(len(self.voltage), stop + 2)
+        pixels = max(1, int(ax.bbox.width))
+        if self.summary is not None and self.method == 'minmax':
+            indices, values = self.summary.envelope(start, stop, pixels)
+        else:
+            indices, values = decimate(self.voltage, start, stop, pixels, self.method)
+        self.line.set_data(self.time[indices], values)
+        ax.figure.canvas.draw_idle()
+
+def plot_spikes(time, voltage, APTimes, titlestr, method='minmax', summary=None):
     """
-    plot_spikes takes four arguments - the recording time array, the voltage
-    array, the time of the detected action potentials, and the title of your
-    plot.  The function creates a labeled plot showing the raw voltage signal
-    and indicating the location of detected spikes with red tick marks (|)
+    plot_spikes takes four arguments - the recording time array (or
+    Timebase), the voltage array, the time of the detected action potentials,
+    and the title of your plot.  The function creates a labeled plot showing
+    the raw voltage signal and indicating the location of detected spikes
+    with red tick marks (|)
+
+    The signal is drawn decimated to the screen resolution ('minmax' keeps
+    every peak, 'lttb' the overall shape); pass method=None to draw every
+    sample.  summary is the recording's optional summary pyramid (see
+    pyramid.py), which saves reading the samples when zoomed out.
     """
+    plt = _pylab()
     plt.figure()
+    ax = plt.gca()
     
     # plot the raw data 
-    plt.plot(time, voltage, 'b', hold=True)
+    if method is None:
+        ax.plot(np.asarray(time), voltage, 'b')
+    else:
+        ax.trace = DecimatedTrace(ax, time, voltage, method, summary, color='b')
 
-    # mark the AP times 
-    plt.plot(APTimes, [max(voltage)+50]*len(APTimes), 'r|', hold=True)
+    # mark the AP times, all in one collection
+    top = np.max(voltage) if summary is None else summary.stats()[0]
+    ax.vlines(np.asarray(APTimes), top + 25, top + 75, colors='r')
 
     # add labels 
     plt.xlabel("Time (s)")
@@ -225,42 +515,50 @@ def plot_spikes(time, voltage, APTimes, titlestr):
     
     plt.show()
     
-def plot_waveforms(time,voltage,APTimes,titlestr):
+def plot_waveforms(time,voltage,APTimes,titlestr,mode='auto',overlay=None,filename=None):
     """
-    plot_waveforms takes four arguments - the recording time array, the voltage
-    array, the time of the detected action potentials, and the title of your
-    plot.  The function creates a labeled plot showing the waveforms for each
-    detected action potential
+    plot_waveforms takes four arguments - the recording time array (or
+    Timebase), the voltage array, the time of the detected action potentials,
+    and the title of your plot.  The function creates a labeled plot showing
+    the waveforms for each detected action potential
+
+    The waveforms are drawn as one line collection, or above a few thousand
+    of them as a time x voltage density image (mode - see rendering.py).
+    overlay optionally adds 'mean', 'median' or percentile curves, e.g.
+    overlay=('mean', 5, 95).  With filename the figure is written to that
+    image file instead of shown, which needs no display.
     """
 
-    plt.figure()
+    import rendering
+    if filename is None:
+        plt = _pylab()
+        fig = plt.figure()
+    else:
+        fig = rendering.headless_figure()
+    ax = fig.gca()
     # note the sampling rate: time[1] - time[0] = .000034375014s 
     # which can serve as our x-axis increments, so our x-axis is 
     # essentially an array from -.003 to .003, of len .006 / .000034375014
     sampling_rate = .006 / (time[1] - time[0])
-    xaxis = np.linspace(-.003, .003, num=sampling_rate)
+    xaxis = np.linspace(-.003, .003, num=int(sampling_rate))
     xincrements = len(xaxis)
     
-    for ap in APTimes:
-        # yaxis is just the corresponding 6 ms from the voltage array (need to find the start and end index) 
-        peak_index = plt.find(time == ap)[0]
-        starting_index = peak_index - xincrements/2
-        ending_index = peak_index + xincrements/2
-        yaxis = voltage[starting_index:ending_index]
-        # hack to make sure arrays are same dimension 
-        # bug I ran into was when the recording is at the very end, and we 
-        # have less than 3ms of voltage data left to create a nice looking waveform.
-        if len(xaxis) != len(yaxis):
-            for x in range(0, (len(xaxis) - len(yaxis))):
-                yaxis = np.insert(yaxis, -1, 0)
-        plt.plot(xaxis, yaxis, 'b', hold=True)
+    # yaxis is just the corresponding 6 ms from the voltage array, gathered
+    # for every spike at once; spikes at the very ends of the recording
+    # (less than 3 ms of data left) are padded with zeros
+    yaxis, _ = extract_waveforms(voltage, spike_indices(time, APTimes),
+                                 xincrements//2, xincrements - xincrements//2)
+    rendering.draw_waveforms(ax, xaxis, yaxis, mode, overlay)
         
     # add labels 
-    plt.xlabel("Time (s)")
-    plt.ylabel("Voltage (uV)")
-    plt.title(titlestr)  
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("Voltage (uV)")
+    ax.set_title(titlestr)  
 
-    plt.show()
+    if filename is None:
+        plt.show()
+    else:
+        fig.savefig(filename)
     
 
         
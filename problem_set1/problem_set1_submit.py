@@ -8,17 +8,15 @@
 ###   From the command prompt: "python problem_set1_submit.py"
 ###
 
-import urllib
-import urllib2
-import hashlib
 import random
-import email
-import email.message
-import email.encoders
 import StringIO
 import sys
+import os
+import threading
 import datetime
 
+from submission import Part, SubmissionClient
+
 """"""""""""""""""""
 """"""""""""""""""""
 
@@ -35,29 +33,27 @@ def submit():
     print '!! Submission Cancelled'
     return
   
-  print '\n== Connecting to Coursera ... '
-
   # Part Identifier
 #  (partIdx, sid) = partPrompt()
 
-  for partIdx in range(10):
-    sid = partIds[partIdx]
+  # every output is ready before anything is sent
+  print '\n== Computing outputs ... '
+  parts = [Part(partIds[partIdx], output(partIdx), source(partIdx)) for partIdx in range(10)]
 
-    print '\n== ' + str(partIdx+1) + ' ' + str(sid)
+  print '\n== Connecting to Coursera ... '
+  lock = threading.Lock()
 
-    # Get Challenge
-    (login, ch, state, ch_aux) = getChallenge(login, sid) #sid is the "part identifier"
-    if((not login) or (not ch) or (not state)):
-      # Some error occured, error string in first return element.
-      print '\n!! Error: %s\n' % login
-      return
-      
-    # Attempt Submission with Challenge
-    ch_resp = challengeResponse(login, password, ch)
-    (result, string) = submitSolution(login, ch_resp, sid, output(partIdx), \
-                                        source(partIdx), state, ch_aux)
+  def report(partIdx, result):
+    with lock:
+      print '\n== ' + str(partIdx+1) + ' ' + str(result.sid)
+      if result.ok:
+        print '== %s' % result.message
+      else:
+        print '\n!! Error: %s\n' % result.message
 
-    print '== %s' % string.strip()
+  # parts are submitted a few at a time over pooled connections, retrying
+  # transient failures (see submission.py)
+  SubmissionClient(base_url()).submit_parts(login, password, parts, report)
 
 
 # =========================== LOGIN HELPERS - NO NEED TO CONFIGURE THIS =======================================
@@ -83,62 +79,10 @@ def partPrompt():
   partIdx = int(raw_input('Please enter which part you want to submit (1-' + str(counter) + '): ')) - 1
   return (partIdx, partIds[partIdx])
 
-def getChallenge(email, sid):
-  """Gets the challenge salt from the server. Returns (email,ch,state,ch_aux)."""
-  url = challenge_url()
-  values = {'email_address' : email, 'assignment_part_sid' : sid, 'response_encoding' : 'delim'}
-  data = urllib.urlencode(values)
-  req = urllib2.Request(url, data)
-  response = urllib2.urlopen(req)
-  text = response.read().strip()
-
-  # text is of the form email|ch|signature
-  splits = text.split('|')
-  if(len(splits) != 9):
-    print 'Badly formatted challenge response: %s' % text
-    return None
-  return (splits[2], splits[4], splits[6], splits[8])
-
-def challengeResponse(email, passwd, challenge):
-  sha1 = hashlib.sha1()
-  sha1.update("".join([challenge, passwd])) # hash the first elements
-  digest = sha1.hexdigest()
-  strAnswer = ''
-  for i in range(0, len(digest)):
-    strAnswer = strAnswer + digest[i]
-  return strAnswer 
-  
-def challenge_url():
-  """Returns the challenge url."""
-  return "https://class.coursera.org/" + URL + "/assignment/challenge"
-
-def submit_url():
-  """Returns the submission url."""
-  return "https://class.coursera.org/" + URL + "/assignment/submit"
-
-def submitSolution(email_address, ch_resp, sid, output, source, state, ch_aux):
-  """Submits a solution to the server. Returns (result, string)."""
-  source_64_msg = email.message.Message()
-  source_64_msg.set_payload(source)
-  email.encoders.encode_base64(source_64_msg)
-
-  output_64_msg = email.message.Message()
-  output_64_msg.set_payload(output)
-  email.encoders.encode_base64(output_64_msg)
-  values = { 'assignment_part_sid' : sid, \
-             'email_address' : email_address, \
-             'submission' : output_64_msg.get_payload(), \
-             'submission_aux' : source_64_msg.get_payload(), \
-             'challenge_response' : ch_resp, \
-             'state' : state \
-           }
-  url = submit_url()  
-  data = urllib.urlencode(values)
-  req = urllib2.Request(url, data)
-  response = urllib2.urlopen(req)
-  string = response.read().strip()
-  result = 0
-  return result, string
+def base_url():
+  """Returns the course url; SUBMIT_BASE_URL overrides it (e.g. for submit_server.py)."""
+  return os.environ.get('SUBMIT_BASE_URL') or "https://class.coursera.org/" + URL
+
 
 ## This collects the source code (just for logging purposes) 
 def source(partIdx):
@@ -152,7 +96,8 @@ def source(partIdx):
 
 ############ BEGIN ASSIGNMENT SPECIFIC CODE - YOU'LL HAVE TO EDIT THIS ##############
 
-from problem_set1 import load_data, good_AP_finder
+from cache import DetectionCache
+from spiketrain import SpikeTrain
 import numpy as np
 
 # Make sure you change this string to the last segment of your class URL.
@@ -168,12 +113,17 @@ partIds = ['spikes-easy-%d%s' % (i,dev) for i in range(1,6)]+['spikes-hard-%d%s'
 partFriendlyNames = ['Spikes Easy %d/5' % (i) for i in range(1,6)]+['Spikes Hard %d/5' % (i) for i in range(1,6)]
 # source files to collect (just for our records)
 sourceFiles = ['problem_set1.py']*10
+# every part of a dataset reuses one detection run
+detections = DetectionCache()
           
 def first_after(time, spikes):
-    spikes = np.array(spikes)
-    if len(spikes) == 0 or spikes[-1] < time:
+    if isinstance(spikes, SpikeTrain):
+        return spikes.first_after(time)
+    spikes = np.sort(spikes)
+    position = np.searchsorted(spikes, time, 'right')
+    if position == len(spikes):
         return 0.0
-    return spikes[np.where(spikes > time)][0]
+    return spikes[position]
          
 def output(partIdx):
   """Uses the student code to compute the output for test cases."""
@@ -181,15 +131,13 @@ def output(partIdx):
 
   if partIdx < 5: # This is spike_easy
       after_list = [.018, .15, 1.1, 1.7, 2.05]
-      t,v = load_data('spikes_easy_test.npy')
-      APTimes = good_AP_finder(t,v)
+      APTimes = detections.detect_file('spikes_easy_test.npy')
       result = [first_after(spk_time, APTimes) for spk_time in after_list]
       outputString = str(result[partIdx])+'\n'
 
   else: # This is spike_hard
       after_list = [ 0.095, 1.31,  1.32,  3.96, 5.97]
-      t,v = load_data('spikes_hard_test.npy')
-      APTimes = good_AP_finder(t,v)
+      APTimes = detections.detect_file('spikes_hard_test.npy')
       result = [first_after(spk_time, APTimes) for spk_time in after_list]
       outputString = str(result[partIdx-5])+'\n'
           
@@ -0,0 +1,310 @@
+#
+#  NAME
+#    pyramid.py
+#
+#  DESCRIPTION
+#    Multi-resolution summary of a recording.  Level 0 holds the min, max,
+#    sum and sum of squared deviations of every BASE samples of each
+#    channel, and each level above summarises FACTOR blocks of the one below
+#    (min, max and sum).  Statistics of the whole recording, or of any
+#    window, and min/max envelopes for plotting are then put together from
+#    blocks instead of scanning every sample; only the partial blocks at the
+#    ends of a window are read from the samples themselves.  The standard
+#    deviation comes from the level-0 blocks, which are voltage_std's, so it
+#    is voltage_std's value to the last bit.
+#
+#    A recording's pyramid is kept beside it in a sidecar file
+#    (<recording>.pyr), or in a directory of its own for recordings in
+#    read-only or shared places.  open_summary builds it on first use, or
+#    again if the recording has changed since, and loads it afterwards; if
+#    the sidecar cannot be written the pyramid is only kept in memory:
+#        summary = open_summary('spikes_easy_test.rec')
+#        good_AP_finder(time, voltage, stats=summary.stats())
+#        plot_spikes(time, voltage, APTimes, 'easy', summary=summary)
+#
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from recording import open_recording, header_gain
+from decimate import minmax_envelope
+from problem_set1 import block_moments, moments_std, STD_BLOCK
+
+# samples per level-0 block (voltage_std's blocks)
+BASE = STD_BLOCK
+# blocks of one level per block of the next
+FACTOR = 16
+SIDECAR = '.pyr'
+# samples read at once while building
+BUILD_CHUNK = BASE << 10
+# summary fields of every level, in file order, and of level 0 only
+FIELDS = ('min', 'max', 'sum')
+BASE_FIELDS = ('squares',)
+# sidecar layout; older sidecars are rebuilt
+FORMAT = 2
+
+class Pyramid(object):
+    """
+    Per-block min, max and sum of every channel of a recording at block
+    sizes BASE, BASE * FACTOR, ..., and at BASE the sum of squared
+    deviations from each block's mean (see problem_set1.block_moments)
+        n_samples - samples per channel
+        levels - one dict of field -> (channels x blocks) array per level
+        samples - optional channels x samples array the pyramid describes,
+            read for the partial blocks at the ends of a window; without
+            it windows are widened to whole level-0 blocks
+        scale - optional per-channel factor applied to every answer (the
+            gain, to answer in volts for a recording stored as counts)
+    """
+
+    def __init__(self, n_samples, levels, base=BASE, factor=FACTOR, samples=None,
+                 scale=None):
+        self.n_samples = int(n_samples)
+        self.levels = levels
+        self.base = base
+        self.factor = factor
+        self.samples = samples
+        n_channels = len(levels[0]['min'])
+        self.scale = np.ones(n_channels) if scale is None else np.asarray(scale, dtype=np.float64)
+
+    @classmethod
+    def build(cls, samples, base=BASE, factor=FACTOR, chunk=BUILD_CHUNK):
+        """
+        Returns the Pyramid of samples (a vector or channels x samples, and
+        may be a memmap), reading chunk samples of a channel at a time
+        """
+        samples = np.asanyarray(samples)
+        if samples.ndim == 1:
+            samples = samples[np.newaxis, :]
+        n_channels, n = samples.shape
+        if n == 0:
+            raise ValueError('cannot summarise an empty recording')
+        chunk = max(base, chunk - chunk % base)
+        n_blocks = -(-n // base)
+        level = dict((field, np.empty((n_channels, n_blocks))) for field in FIELDS + BASE_FIELDS)
+        for channel in range(n_channels):
+            for start in range(0, n, chunk):
+                segment = np.asarray(samples[channel, start:start + chunk])
+                edges = np.arange(0, len(segment), base)
+                blocks = slice(start // base, start // base + len(edges))
+                level['min'][channel, blocks] = np.minimum.reduceat(segment, edges)
+                level['max'][channel, blocks] = np.maximum.reduceat(segment, edges)
+                counts, sums, squares = block_moments(segment, base)
+                level['sum'][channel, blocks] = sums
+                level['squares'][channel, blocks] = squares
+        levels = [level]
+        while len(levels[-1]['min'][0]) > 1:
+            below = levels[-1]
+            edges = np.arange(0, len(below['min'][0]), factor)
+            levels.append({'min': np.minimum.reduceat(below['min'], edges, axis=1),
+                           'max': np.maximum.reduceat(below['max'], edges, axis=1),
+                           'sum': np.add.reduceat(below['sum'], edges, axis=1)})
+        return cls(n, levels, base, factor, samples)
+
+    @property
+    def n_channels(self):
+        return len(self.scale)
+
+    def block_size(self, level):
+        return self.base * self.factor ** level
+
+    def save(self, f, **metadata):
+        """Writes the pyramid (not its samples) to a file or file name, as npz"""
+        arrays = dict(('%s_%d' % (field, k), values)
+                      for k, level in enumerate(self.levels) for field, values in level.items())
+        metadata.update(n_samples=self.n_samples, base=self.base, factor=self.factor,
+                        n_levels=len(self.levels), format=FORMAT)
+        arrays.update(('meta_' + name, np.asarray(value)) for name, value in metadata.items())
+        np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, f, samples=None, scale=None):
+        """Returns (Pyramid, metadata dict) read from a file written by save"""
+        data = np.load(f)
+        metadata = dict((name[5:], data[name][()]) for name in data.files
+                        if name.startswith('meta_'))
+        if int(metadata.get('format', 1)) != FORMAT:
+            raise ValueError('pyramid format %s, not %d' % (metadata.get('format', 1), FORMAT))
+        levels = [dict((field, data['%s_%d' % (field, k)])
+                       for field in (FIELDS + BASE_FIELDS if k == 0 else FIELDS))
+                  for k in range(int(metadata['n_levels']))]
+        return cls(metadata['n_samples'], levels, int(metadata['base']),
+                   int(metadata['factor']), samples, scale), metadata
+
+    def _cover(self, start, stop, level=None, pieces=None):
+        """
+        Returns [(level, first, last)] block ranges, and (None, start, stop)
+        sample ranges at the ends, that exactly cover samples [start, stop)
+        """
+        if pieces is None:
+            pieces = []
+            level = len(self.levels) - 1
+        if start >= stop:
+            return pieces
+        if level < 0:
+            pieces.append((None, start, stop))
+            return pieces
+        size = self.block_size(level)
+        n_blocks = len(self.levels[level]['min'][0])
+        # the last block may be short; it is whole if stop reaches the end
+        first = -(-start // size)
+        last = n_blocks if stop >= self.n_samples else stop // size
+        if first >= last:
+            return self._cover(start, stop, level - 1, pieces)
+        self._cover(start, first * size, level - 1, pieces)
+        pieces.append((level, first, last))
+        self._cover(min(last * size, self.n_samples), stop, level - 1, pieces)
+        return pieces
+
+    def _window(self, start, stop):
+        start = max(0, int(start))
+        stop = self.n_samples if stop is None else min(self.n_samples, int(stop))
+        if self.samples is None:
+            # no samples to read: widen to whole level-0 blocks
+            start -= start % self.base
+            stop = min(self.n_samples, -(-stop // self.base) * self.base)
+        if start >= stop:
+            raise ValueError('empty window [%d, %d)' % (start, stop))
+        return start, stop
+
+    def moments(self, start=0, stop=None, channel=0):
+        """
+        Returns (count, sum, max, min) of samples [start, stop) of channel,
+        in stored units
+        """
+        start, stop = self._window(start, stop)
+        count, total = 0, 0.0
+        high, low = -np.inf, np.inf
+        for level, first, last in self._cover(start, stop):
+            if level is None:
+                values = np.asarray(self.samples[channel, first:last], dtype=np.float64)
+                count += len(values)
+                total += values.sum()
+                high, low = max(high, values.max()), min(low, values.min())
+            else:
+                blocks = self.levels[level]
+                count += min(last * self.block_size(level), self.n_samples) - \
+                    first * self.block_size(level)
+                total += blocks['sum'][channel, first:last].sum()
+                high = max(high, blocks['max'][channel, first:last].max())
+                low = min(low, blocks['min'][channel, first:last].min())
+        return count, total, high, low
+
+    def std(self, start=0, stop=None, channel=0):
+        """
+        Returns the standard deviation of samples [start, stop) of channel,
+        in stored units, from the level-0 blocks in the window and the
+        block_moments of the samples at its ends (by moments_std, so over
+        the whole recording it is exactly voltage_std's)
+        """
+        start, stop = self._window(start, stop)
+        level = self.levels[0]
+        first = -(-start // self.base)
+        last = len(level['sum'][channel]) if stop >= self.n_samples else stop // self.base
+        if first >= last:
+            pieces = [block_moments(self.samples[channel, start:stop], self.base)]
+        else:
+            ends = np.minimum(np.arange(first + 1, last + 1) * self.base, self.n_samples)
+            counts = (ends - np.arange(first, last) * self.base).astype(np.float64)
+            pieces = [(counts, level['sum'][channel, first:last],
+                       level['squares'][channel, first:last])]
+            if start < first * self.base:
+                pieces.insert(0, block_moments(self.samples[channel, start:first * self.base],
+                                               self.base))
+            if ends[-1] < stop:
+                pieces.append(block_moments(self.samples[channel, ends[-1]:stop], self.base))
+        return moments_std(*[np.concatenate(column) for column in zip(*pieces)])
+
+    def stats(self, start=0, stop=None, channel=0):
+        """
+        Returns (max, min, std) of samples [start, stop) of channel, like
+        streaming.stream_stats, so they can be handed to good_AP_finder
+        """
+        high, low = self.moments(start, stop, channel)[2:]
+        std = self.std(start, stop, channel)
+        scale = self.scale[channel]
+        return float(high * scale), float(low * scale), float(std * scale)
+
+    def mean(self, start=0, stop=None, channel=0):
+        """Returns the mean of samples [start, stop) of channel"""
+        count, total = self.moments(start, stop, channel)[:2]
+        return float(total / count * self.scale[channel])
+
+    def envelope(self, start, stop, n_bins, channel=0):
+        """
+        Like decimate.minmax_envelope on channel, but put together from the
+        coarsest level whose blocks fit in a bin.  Bin edges are rounded to
+        that level's blocks, which is well inside a pixel on screen; short
+        ranges are read from the samples.
+        """
+        start, stop = max(0, int(start)), min(self.n_samples, int(stop))
+        bin_size = (stop - start) // max(1, n_bins)
+        fitting = [level for level in range(len(self.levels))
+                   if self.block_size(level) <= bin_size]
+        if not fitting and self.samples is not None:
+            indices, values = minmax_envelope(self.samples[channel], start, stop, n_bins)
+            return indices, values * self.scale[channel]
+        level = fitting[-1] if fitting else 0
+        size = self.block_size(level)
+        first, last = start // size, -(-stop // size)
+        n_bins = min(n_bins, last - first)
+        edges = (np.arange(n_bins) * (last - first)) // n_bins
+        blocks = self.levels[level]
+        values = np.empty(2 * n_bins)
+        values[0::2] = np.minimum.reduceat(blocks['min'][channel, first:last], edges)
+        values[1::2] = np.maximum.reduceat(blocks['max'][channel, first:last], edges)
+        indices = np.maximum(np.repeat((edges + first) * size, 2), start)
+        return indices, values * self.scale[channel]
+
+def sidecar_path(filename, directory=None):
+    """
+    Returns the name of the summary sidecar of a recording file: beside it,
+    or in directory, named apart by a hash of the recording's full path
+    """
+    if directory is None:
+        return filename + SIDECAR
+    path = os.path.abspath(filename)
+    return os.path.join(directory, '%s.%s%s' % (os.path.basename(path),
+                                                hashlib.sha1(path).hexdigest()[:12], SIDECAR))
+
+def open_summary(filename, counts=False, base=BASE, factor=FACTOR, directory=None):
+    """
+    Returns the Pyramid of a recording file, loading its sidecar, or
+    building and saving it first if there is none or the recording has
+    changed since.  Like load_data, answers are in volts unless counts is
+    True, in which case they are in the stored units.  Sidecars go in
+    directory if given (see sidecar_path); when one cannot be written the
+    built pyramid is returned all the same.
+    """
+    header, samples = open_recording(filename)
+    scale = None if counts else header_gain(header)
+    stat = os.stat(filename)
+    path = sidecar_path(filename, directory)
+    if os.path.exists(path):
+        try:
+            summary, metadata = Pyramid.load(path, samples, scale)
+            if (int(metadata['size']) == stat.st_size and float(metadata['mtime']) == stat.st_mtime
+                    and (summary.base, summary.factor) == (base, factor)):
+                return summary
+        except (IOError, KeyError, ValueError):
+            pass
+    summary = Pyramid.build(samples, base, factor)
+    summary.scale = summary.scale if scale is None else scale
+    # write then rename, so a reader never sees half a file
+    temp = None
+    try:
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                        suffix=SIDECAR)
+        with os.fdopen(handle, 'wb') as f:
+            summary.save(f, size=stat.st_size, mtime=stat.st_mtime)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        # read-only or full: rebuilt next time instead
+        if temp is not None and os.path.exists(temp):
+            os.remove(temp)
+    return summary
@@ -0,0 +1,401 @@
+#
+#  NAME
+#    recording.py
+#
+#  DESCRIPTION
+#    On-disk recording format.  A recording file is a short JSON header
+#    followed by the raw samples, stored channel by channel so each channel
+#    is one contiguous run.  Files are opened with numpy.memmap: nothing is
+#    unpickled or copied, and pages are only read when the samples are used.
+#
+#    Samples are usually int16 ADC counts, as the acquisition hardware
+#    produces them, with a gain per channel (microvolts per count) in the
+#    header; this is a quarter the size of float64 volts.  Floating point
+#    recordings are supported too and have no gain.
+#
+#    Legacy course files (spikes_*.npy, a pickled dict of 'time' and
+#    'voltage') can be converted once with convert_legacy, or from the
+#    command line:
+#        python recording.py spikes_easy_test.npy spikes_hard_test.npy
+#    which also builds each new recording's summary pyramid (see pyramid.py).
+#
+
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b'\x93SPKREC\x01'
+EXTENSION = '.rec'
+# the samples start on a page boundary
+ALIGNMENT = 4096
+# a legacy time vector is only replaced by a Timebase that gives back
+# every one of its times to within this many ulps of the largest
+UNIFORM_ULPS = 4
+# sample type of converted recordings
+COUNT_DTYPE = np.int16
+# samples scaled at once when a ScaledView is read whole
+SCALE_BLOCK = 1 << 20
+
+class Timebase(object):
+    """
+    Uniformly sampled time axis: sample i is at t0 + i * dt seconds, for
+    i in range(n).  It stands in for a full time vector - len(), indexing
+    with ints, slices and index arrays, and np.asarray() all behave like the
+    array it describes - without storing n float64 values, and converts
+    between times and sample indices with arithmetic instead of searching.
+    """
+
+    def __init__(self, t0, dt, n):
+        if dt <= 0:
+            raise ValueError('dt must be positive, got %r' % (dt,))
+        self.t0 = float(t0)
+        self.dt = float(dt)
+        self.n = int(n)
+
+    @classmethod
+    def from_times(cls, time):
+        """
+        Returns the Timebase equal to the vector time, or None if time is
+        not uniformly sampled to float rounding (see UNIFORM_ULPS), so the
+        spike times reported are the file's own
+        """
+        if isinstance(time, Timebase):
+            return time
+        time = np.asarray(time, dtype=np.float64)
+        if len(time) < 2:
+            return None
+        dt = (time[-1] - time[0]) / (len(time) - 1)
+        if not dt > 0:
+            return None
+        timebase = cls(time[0], dt, len(time))
+        error = np.abs(timebase.times(np.arange(len(time))) - time).max()
+        if error > UNIFORM_ULPS * np.spacing(np.abs(time).max()):
+            return None
+        return timebase
+
+    @property
+    def sample_rate(self):
+        return 1.0 / self.dt
+
+    @property
+    def duration(self):
+        return self.n * self.dt
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return 'Timebase(t0=%r, dt=%r, n=%r)' % (self.t0, self.dt, self.n)
+
+    def __eq__(self, other):
+        return (isinstance(other, Timebase) and
+                (self.t0, self.dt, self.n) == (other.t0, other.dt, other.n))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.n)
+            if step > 0:
+                count = max(0, (stop - start + step - 1) // step)
+                return Timebase(self.times(start), self.dt * step, count)
+            return self.times(np.arange(start, stop, step))
+        if np.ndim(key) == 0:
+            index = int(key)
+            if not -self.n <= index < self.n:
+                raise IndexError('index %d is out of bounds for %d samples' % (index, self.n))
+            return self.times(index % self.n)
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        if len(key) and (key.min() < -self.n or key.max() >= self.n):
+            raise IndexError('index out of bounds for %d samples' % self.n)
+        return self.times(np.where(key < 0, key + self.n, key))
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.times(np.arange(self.n)), dtype=dtype)
+
+    def times(self, indices):
+        """Returns the time in seconds of each sample index"""
+        return self.t0 + np.asarray(indices) * self.dt
+
+    def index(self, times):
+        """Returns the sample index nearest each time (not bounds checked)"""
+        return np.rint((np.asarray(times) - self.t0) / self.dt).astype(np.intp)
+
+def time_index(time, times):
+    """
+    Returns the index of the sample nearest each of times, where time is a
+    Timebase or a sorted time vector
+    """
+    if isinstance(time, Timebase):
+        return time.index(times)
+    time = np.asarray(time)
+    index = np.clip(np.searchsorted(time, times), 1, len(time) - 1)
+    # step back where the previous sample is nearer
+    return index - (np.asarray(times) - time[index - 1] < time[index] - np.asarray(times))
+
+def is_recording(filename):
+    """Returns True if filename starts with the recording file magic"""
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def header_timebase(header):
+    """Returns the Timebase of a recording from its header"""
+    return Timebase(header['start_time'], 1.0 / header['sample_rate'], header['n_samples'])
+
+def channel_ids(header):
+    """Returns the id of each channel of a recording from its header"""
+    return header.get('channel_ids', list(range(header['n_channels'])))
+
+def header_gain(header):
+    """
+    Returns the gain (volts per sample unit) of each channel of a recording
+    from its header; 1 for recordings stored as volts
+    """
+    return np.asarray(header.get('gain', [1.0] * header['n_channels']), dtype=np.float64)
+
+class ScaledView(object):
+    """
+    Read-only float32 voltage view of integer counts (a vector, or channels
+    x samples with a gain per channel).  Indexing scales only the samples
+    asked for, so the counts can stay a memmap; np.asarray(view) scales
+    the whole array, a block at a time.  Detection runs on view.counts and
+    view.gain directly (see problem_set1.good_AP_finder).
+    """
+
+    dtype = np.dtype(np.float32)
+
+    def __init__(self, counts, gain):
+        self.counts = counts
+        self.gain = np.float32(gain) if counts.ndim == 1 else \
+            np.asarray(gain, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    @property
+    def ndim(self):
+        return self.counts.ndim
+
+    def __getitem__(self, key):
+        samples = self.counts[key]
+        gain = self.gain
+        if self.counts.ndim == 2:
+            gain = gain[key[0] if isinstance(key, tuple) else key]
+            if np.ndim(samples) == 2:
+                gain = gain[:, np.newaxis]
+        return np.multiply(samples, gain, dtype=np.float32)
+
+    def __array__(self, dtype=None):
+        voltage = np.empty(self.shape, dtype=np.float32)
+        for start in range(0, self.shape[-1], SCALE_BLOCK):
+            block = (Ellipsis, slice(start, start + SCALE_BLOCK))
+            voltage[block] = self[block]
+        return voltage if dtype is None else voltage.astype(dtype)
+
+    def max(self, axis=None, out=None):
+        if axis is not None or out is not None:
+            return np.asarray(self).max(axis, out)
+        return self._extreme(np.max)
+
+    def min(self, axis=None, out=None):
+        if axis is not None or out is not None:
+            return np.asarray(self).min(axis, out)
+        return self._extreme(np.min)
+
+    def _extreme(self, pick):
+        counts = self.counts if self.counts.ndim == 2 else self.counts[np.newaxis, :]
+        # gains are positive, so each channel's extreme count is its extreme voltage
+        return pick([np.float32(pick(row)) * g for row, g in zip(counts, np.atleast_1d(self.gain))])
+
+def choose_gain(voltage, dtype=COUNT_DTYPE):
+    """
+    Returns the gain of each channel (rows of voltage, or a vector) that
+    spreads its largest excursion over the full range of integer dtype
+    """
+    voltage = np.asanyarray(voltage)
+    if voltage.ndim == 1:
+        voltage = voltage[np.newaxis, :]
+    peak = np.array([np.abs(channel).max() if len(channel) else 0.0 for channel in voltage])
+    return np.where(peak > 0, peak, 1.0) / np.iinfo(dtype).max
+
+def to_counts(voltage, gain, dtype=COUNT_DTYPE):
+    """Returns voltage divided by gain, rounded and clipped to integer dtype"""
+    limit = np.iinfo(dtype).max
+    # symmetric range, so abs() of a count always fits the type
+    return np.clip(np.rint(np.asarray(voltage) / gain), -limit, limit).astype(dtype)
+
+def read_header(filename):
+    """
+    Returns the header dict of a recording file.  It holds
+        sample_rate - samples per second
+        start_time - time of the first sample in seconds
+        dtype - numpy dtype string of the samples
+        n_channels, n_samples - shape of the payload
+        channel_ids - optional id of each channel
+        gain - volts per count of each channel, for integer samples
+        offset - byte offset of the first sample
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a recording file' % filename)
+        length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length).decode('ascii'))
+    return header
+
+def open_recording(filename, mode='r'):
+    """
+    Returns (header, samples) for a recording file, where samples is a
+    read-only memmap of shape (n_channels, n_samples).  Integer samples are
+    counts; multiply by header_gain(header) for volts.
+    """
+    header = read_header(filename)
+    samples = np.memmap(filename, dtype=np.dtype(str(header['dtype'])), mode=mode,
+                        offset=header['offset'],
+                        shape=(header['n_channels'], header['n_samples']))
+    return header, samples
+
+class RecordingWriter(object):
+    """
+    Writes a recording file piece by piece.  The header is written and the
+    file sized up front; write() then fills in any range of samples, so a
+    recording can be produced block by block without holding it in memory.
+    With an integer dtype, gain gives the volts per count of each channel
+    (or all of them) and floating point samples passed to write() are
+    converted to counts; integer samples are taken as counts already.
+    Use it as a context manager:
+        with RecordingWriter(filename, n_channels, n_samples, sample_rate) as writer:
+            writer.write(0, first_block)
+    """
+
+    def __init__(self, filename, n_channels, n_samples, sample_rate, start_time=0.0,
+                 dtype=np.float64, channel_ids=None, gain=None):
+        self.dtype = np.dtype(dtype)
+        self.gain = None
+        header = {'sample_rate': float(sample_rate),
+                  'start_time': float(start_time),
+                  'dtype': self.dtype.str,
+                  'n_channels': int(n_channels),
+                  'n_samples': int(n_samples)}
+        if channel_ids is not None:
+            if len(channel_ids) != n_channels:
+                raise ValueError('%d channel ids for %d channels'
+                                 % (len(channel_ids), n_channels))
+            header['channel_ids'] = [int(channel) for channel in channel_ids]
+        if gain is not None:
+            if self.dtype.kind not in 'iu':
+                raise ValueError('gain needs integer samples, not %s' % self.dtype)
+            self.gain = np.broadcast_to(np.asarray(gain, dtype=np.float64), (n_channels,))
+            header['gain'] = [float(value) for value in self.gain]
+        # the offset is part of the header, so size it with room to spare
+        fixed = len(MAGIC) + 4
+        header['offset'] = 0
+        length = len(json.dumps(header, sort_keys=True)) + 16
+        header['offset'] = -(-(fixed + length) // ALIGNMENT) * ALIGNMENT
+        text = json.dumps(header, sort_keys=True).encode('ascii')
+        text += b' ' * (header['offset'] - fixed - len(text))
+        self.header = header
+
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(struct.pack('<I', len(text)))
+        self.file.write(text)
+        self.file.truncate(header['offset'] + n_channels * n_samples * self.dtype.itemsize)
+
+    def write(self, start, samples):
+        """
+        Writes samples (channels x k, or a vector for one channel) as
+        samples [start, start + k) of every channel
+        """
+        samples = np.asanyarray(samples)
+        if samples.ndim == 1:
+            samples = samples[np.newaxis, :]
+        n_channels, n_samples = self.header['n_channels'], self.header['n_samples']
+        if len(samples) != n_channels or start < 0 or start + samples.shape[1] > n_samples:
+            raise ValueError('cannot write shape %r at sample %d of a %d x %d recording'
+                             % (samples.shape, start, n_channels, n_samples))
+        for channel, values in enumerate(samples):
+            self.write_channel(channel, start, values)
+
+    def write_channel(self, channel, start, values):
+        """Writes the vector values as samples [start, ...) of one channel"""
+        self.file.seek(self.header['offset'] +
+                       (channel * self.header['n_samples'] + start) * self.dtype.itemsize)
+        values = np.asarray(values)
+        if self.gain is not None and values.dtype.kind == 'f':
+            values = to_counts(values, self.gain[channel], self.dtype)
+        np.asarray(values, dtype=self.dtype).tofile(self.file)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def write_recording(filename, voltage, sample_rate, start_time=0.0, dtype=None,
+                    channel_ids=None, gain=None):
+    """
+    Writes voltage (a vector, or a channels x samples array) to filename in
+    the recording format.  The samples are copied one channel at a time, so
+    voltage may itself be a memmap larger than memory.  channel_ids
+    optionally names each channel (by default they are 0, 1, ...).
+
+    To store floating point voltage as integer counts pass an integer
+    dtype; gain defaults to choose_gain(voltage, dtype).
+    """
+    voltage = np.asanyarray(voltage)
+    if voltage.ndim == 1:
+        voltage = voltage[np.newaxis, :]
+    if voltage.ndim != 2:
+        raise ValueError('voltage must be 1-D or channels x samples, got shape %r'
+                         % (voltage.shape,))
+    dtype = np.dtype(dtype or voltage.dtype)
+    if gain is None and dtype.kind in 'iu' and voltage.dtype.kind == 'f':
+        gain = choose_gain(voltage, dtype)
+    with RecordingWriter(filename, voltage.shape[0], voltage.shape[1], sample_rate,
+                         start_time, dtype, channel_ids, gain) as writer:
+        for channel, values in enumerate(voltage):
+            writer.write_channel(channel, 0, values)
+    return writer.header
+
+def convert_legacy(filename, out_filename=None, dtype=COUNT_DTYPE):
+    """
+    Converts a legacy spikes_*.npy dict file to the recording format and
+    returns the name of the new file (by default the same name with a .rec
+    extension).  The time vector must be uniformly sampled; it is replaced by
+    its start time and sample rate.  The voltage is stored as dtype, by
+    default int16 counts scaled to the largest excursion of each channel.
+    """
+    if out_filename is None:
+        out_filename = os.path.splitext(filename)[0] + EXTENSION
+    data = np.load(filename, allow_pickle=True)[()]
+    time = np.asarray(data['time'], dtype=np.float64)
+    voltage = np.asarray(data['voltage'])
+
+    if len(time) != voltage.shape[-1]:
+        raise ValueError('%s: time and voltage do not line up' % filename)
+    timebase = Timebase.from_times(time)
+    if timebase is None:
+        raise ValueError('%s is not uniformly sampled' % filename)
+
+    write_recording(out_filename, voltage, timebase.sample_rate, timebase.t0, dtype)
+    return out_filename
+
+if __name__ == "__main__":
+    from pyramid import open_summary
+    for name in sys.argv[1:]:
+        out_filename = convert_legacy(name)
+        open_summary(out_filename)
+        print '%s -> %s' % (name, out_filename)
@@ -0,0 +1,111 @@
+#
+#  NAME
+#    rendering.py
+#
+#  DESCRIPTION
+#    Drawing many spike waveforms at once.  One Line2D per waveform becomes
+#    unusable in the thousands, so waveforms are drawn either as a single
+#    LineCollection or, for large counts, accumulated into a time x voltage
+#    density histogram shown as one image.  Mean, median and percentile
+#    curves can be laid over either.  Figures can also be rendered straight
+#    to image files with the Agg canvas, without pyplot or a display, for
+#    batch reports.
+#
+#    This module imports matplotlib; problem_set1 only imports it when
+#    plotting.
+#
+
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+MODES = ('auto', 'lines', 'collection', 'density')
+# above this many waveforms 'auto' draws a density image
+DENSITY_SPIKES = 2000
+# voltage bins of the density image
+DENSITY_BINS = 256
+# waveforms binned at once, to bound the temporaries
+DENSITY_CHUNK = 8192
+
+def waveform_density(waveforms, bins=DENSITY_BINS, vrange=None, chunk=DENSITY_CHUNK):
+    """
+    Returns (counts, edges): counts[b, s] is the number of waveforms
+    (rows of waveforms) whose sample s falls in voltage bin b, and edges
+    the bins + 1 voltage bin edges spanning vrange (by default the range of
+    the waveforms)
+    """
+    waveforms = np.asarray(waveforms)
+    n_samples = waveforms.shape[1]
+    if vrange is None:
+        vrange = (float(waveforms.min()), float(waveforms.max())) if waveforms.size else (0.0, 1.0)
+    low, high = vrange
+    if high <= low:
+        high = low + 1.0
+    counts = np.zeros(bins * n_samples, dtype=np.intp)
+    columns = np.arange(n_samples)
+    for start in range(0, len(waveforms), chunk):
+        block = np.asarray(waveforms[start:start + chunk], dtype=np.float64)
+        rows = np.clip(((block - low) * (bins / (high - low))).astype(np.intp), 0, bins - 1)
+        counts += np.bincount((rows * n_samples + columns).ravel(),
+                              minlength=bins * n_samples)
+    return counts.reshape(bins, n_samples), np.linspace(low, high, bins + 1)
+
+def overlay_curves(waveforms, overlay):
+    """
+    Returns [(label, curve)] for each entry of overlay: 'mean', 'median',
+    or a number for that percentile
+    """
+    curves = []
+    for item in overlay:
+        if item == 'mean':
+            curves.append(('mean', waveforms.mean(axis=0)))
+        elif item == 'median':
+            curves.append(('median', np.median(waveforms, axis=0)))
+        else:
+            curves.append(('%g%%' % item, np.percentile(waveforms, item, axis=0)))
+    return curves
+
+def draw_waveforms(ax, xaxis, waveforms, mode='auto', overlay=None, color='b',
+                   bins=DENSITY_BINS):
+    """
+    Draws waveforms (one per row, against xaxis) on ax as individual
+    lines, one LineCollection, or a density image (see MODES; 'auto' picks
+    the collection up to DENSITY_SPIKES waveforms and the image above).
+    overlay optionally lists curves to draw on top (see overlay_curves).
+    Returns the mode used.
+    """
+    waveforms = np.asarray(waveforms)
+    if mode == 'auto':
+        mode = 'density' if len(waveforms) > DENSITY_SPIKES else 'collection'
+    if mode == 'lines':
+        ax.plot(xaxis, waveforms.T, color=color)
+    elif mode == 'collection':
+        segments = np.empty(waveforms.shape + (2,))
+        segments[:, :, 0] = xaxis
+        segments[:, :, 1] = waveforms
+        ax.add_collection(LineCollection(segments, colors=color))
+        ax.autoscale_view()
+    elif mode == 'density':
+        counts, edges = waveform_density(waveforms, bins)
+        step = (xaxis[-1] - xaxis[0]) / max(1, len(xaxis) - 1)
+        # log scale, so the rare outliers stay visible next to the dense core
+        ax.imshow(np.log1p(counts), origin='lower', aspect='auto', cmap='viridis',
+                  interpolation='nearest',
+                  extent=(xaxis[0] - step / 2.0, xaxis[-1] + step / 2.0, edges[0], edges[-1]))
+    else:
+        raise ValueError('mode must be one of %s, got %r' % (MODES, mode))
+    if overlay and len(waveforms):
+        for label, curve in overlay_curves(waveforms, overlay):
+            ax.plot(xaxis, curve, color='w' if mode == 'density' else 'k',
+                    linestyle='-' if label in ('mean', 'median') else '--', label=label)
+    return mode
+
+def headless_figure(**kwargs):
+    """
+    Returns a Figure drawn by the Agg canvas, independent of pyplot and the
+    display; save it with fig.savefig(filename)
+    """
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
@@ -0,0 +1,212 @@
+#
+#  NAME
+#    sorting.py
+#
+#  DESCRIPTION
+#    Spike sorting: telling apart the neurons behind the detected spikes.
+#    The waveform snippet around every spike is reduced to a few principal
+#    components and the spikes are clustered in that space, one cluster per
+#    unit.  Snippets are cut from the voltage a batch at a time in every
+#    pass, and both steps only keep running sums (the PCA a covariance
+#    matrix, the k-means its centres and counts), so memory depends on the
+#    batch size and snippet length, not on the number of spikes; only a
+#    label per spike is kept.
+#        pass 1 - mean and covariance of the snippets -> components
+#        pass 2 - mini-batch k-means on the projections (n_epochs times)
+#        pass 3 - label every spike with its nearest centre
+#
+#        sorting = sort_spikes(time, voltage, good_AP_finder(time, voltage), n_units=3)
+#        for unit, APTimes in sorting.units.items(): ...
+#
+
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+import instrument
+from problem_set1 import detection_input
+from spiketrain import SpikeTrain, spike_indices
+from waveforms import extract_waveforms
+
+# snippet around each spike, in seconds
+SNIPPET_BEFORE = .0008
+SNIPPET_AFTER = .0012
+# spikes per batch
+BATCH_SIZE = 16384
+
+class StreamingPCA(object):
+    """
+    PCA fitted one batch of rows at a time.  The mean and scatter matrix
+    are combined batch by batch (Chan et al.), so the components are those
+    of all the rows together, without holding them.
+    """
+
+    def __init__(self, n_components):
+        self.n_components = n_components
+        self.count = 0
+        self.mean = None
+        self.scatter = None
+        self.components = None
+        self.explained_variance = None
+
+    def partial_fit(self, rows):
+        rows = np.asarray(rows, dtype=np.float64)
+        if len(rows) == 0:
+            return
+        batch_mean = rows.mean(axis=0)
+        centred = rows - batch_mean
+        batch_scatter = np.dot(centred.T, centred)
+        if self.count == 0:
+            self.mean, self.scatter = batch_mean, batch_scatter
+        else:
+            total = self.count + len(rows)
+            delta = batch_mean - self.mean
+            self.mean = self.mean + delta * len(rows) / total
+            self.scatter += batch_scatter + np.outer(delta, delta) * self.count * len(rows) / total
+        self.count += len(rows)
+
+    def finish(self):
+        """Computes the components from what has been fitted"""
+        if self.count < 2:
+            raise ValueError('need at least 2 rows for PCA, got %d' % self.count)
+        variance, vectors = np.linalg.eigh(self.scatter / (self.count - 1))
+        order = np.argsort(variance)[::-1][:self.n_components]
+        self.explained_variance = variance[order]
+        self.components = vectors[:, order].T
+        # fix the signs, so the same data always gives the same components
+        flip = np.sign(self.components[np.arange(len(order)),
+                                       np.abs(self.components).argmax(axis=1)])
+        self.components *= flip[:, np.newaxis]
+        return self
+
+    def transform(self, rows):
+        return np.dot(np.asarray(rows, dtype=np.float64) - self.mean, self.components.T)
+
+class MiniBatchKMeans(object):
+    """
+    k-means fitted one batch at a time: each centre moves to the mean of
+    every point ever assigned to it (Sculley, "Web-scale k-means
+    clustering").  Centres start by k-means++ seeding on the first batch.
+    """
+
+    def __init__(self, n_clusters, seed=None):
+        self.n_clusters = n_clusters
+        self.rng = np.random.RandomState(seed)
+        self.centers = None
+        self.counts = np.zeros(n_clusters)
+
+    def _seed(self, points):
+        centers = [points[self.rng.randint(len(points))]]
+        distance = ((points - centers[0]) ** 2).sum(axis=1)
+        for k in range(1, self.n_clusters):
+            if distance.sum() > 0:
+                choice = self.rng.choice(len(points), p=distance / distance.sum())
+            else:
+                choice = self.rng.randint(len(points))
+            centers.append(points[choice])
+            distance = np.minimum(distance, ((points - points[choice]) ** 2).sum(axis=1))
+        self.centers = np.array(centers)
+
+    def predict(self, points):
+        """Returns the index of the nearest centre to each point"""
+        points = np.asarray(points, dtype=np.float64)
+        # |p - c|^2 without the |p|^2 term, which is the same for every centre
+        distance = (self.centers ** 2).sum(axis=1) - 2 * np.dot(points, self.centers.T)
+        return distance.argmin(axis=1)
+
+    def partial_fit(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        if len(points) == 0:
+            return
+        if self.centers is None:
+            self._seed(points)
+        labels = self.predict(points)
+        batch_counts = np.bincount(labels, minlength=self.n_clusters).astype(np.float64)
+        sums = np.zeros_like(self.centers)
+        np.add.at(sums, labels, points)
+        total = self.counts + batch_counts
+        moved = batch_counts > 0
+        self.centers[moved] += (sums[moved] - batch_counts[moved, np.newaxis] *
+                                self.centers[moved]) / total[moved, np.newaxis]
+        self.counts = total
+        # a centre nothing has reached yet restarts at a random point
+        for k in np.flatnonzero(self.counts == 0):
+            self.centers[k] = points[self.rng.randint(len(points))]
+
+Sorting = namedtuple('Sorting', ['units', 'labels', 'pca', 'kmeans'])
+
+def iter_snippets(voltage, indices, before, after, batch_size=BATCH_SIZE, gain=None):
+    """Yields (start, snippets) for the spikes at indices, batch_size at a time"""
+    for start in range(0, len(indices), batch_size):
+        snippets, _ = extract_waveforms(voltage, indices[start:start + batch_size],
+                                        before, after, dtype=np.float64, gain=gain)
+        yield start, snippets
+
+def sort_spikes(time, voltage, APTimes, n_units=3, n_components=3,
+                before=SNIPPET_BEFORE, after=SNIPPET_AFTER, batch_size=BATCH_SIZE,
+                n_epochs=2, seed=0):
+    """
+    This function takes the following input:
+        time - vector of sample times in seconds, or a Timebase
+        voltage - vector of voltages (may be a memmap, or a ScaledView of
+            integer counts from load_data, whose snippets are scaled one
+            batch at a time)
+        APTimes - the detected spikes (a SpikeTrain, or their times)
+        n_units - number of units (clusters) to sort the spikes into
+        n_components - principal components to cluster on
+        before, after - seconds of waveform to use around each spike
+        batch_size - spikes whose snippets are held at once
+        n_epochs - k-means passes over the spikes
+        seed - random seed of the k-means
+
+    This function returns the following output:
+        sorting - a Sorting of
+            units - OrderedDict from unit number to that unit's SpikeTrain,
+                largest unit first
+            labels - the unit of every spike in APTimes
+            pca, kmeans - the fitted StreamingPCA and MiniBatchKMeans
+    """
+    if not isinstance(APTimes, SpikeTrain):
+        APTimes = SpikeTrain(spike_indices(time, APTimes), time)
+    indices = APTimes.indices
+    if len(indices) < max(2, n_units):
+        raise ValueError('need at least %d spikes to sort into %d units, got %d'
+                         % (max(2, n_units), n_units, len(indices)))
+    SAMPLING_RATE = time[1]-time[0]
+    samples_before = int(round(before / SAMPLING_RATE))
+    samples_after = int(round(after / SAMPLING_RATE))
+    voltage, gain, _ = detection_input(voltage)
+
+    run = instrument.current()
+    pca = StreamingPCA(n_components)
+    with run.stage('pca'):
+        for start, snippets in iter_snippets(voltage, indices, samples_before,
+                                             samples_after, batch_size, gain):
+            pca.partial_fit(snippets)
+        pca.finish()
+
+    # shuffled batches, so every batch of the k-means sees the whole recording
+    order = np.random.RandomState(seed).permutation(len(indices))
+    kmeans = MiniBatchKMeans(n_units, seed)
+    with run.stage('clustering'):
+        for epoch in range(n_epochs):
+            for start in range(0, len(order), batch_size):
+                batch = np.sort(order[start:start + batch_size])
+                snippets, _ = extract_waveforms(voltage, indices[batch], samples_before,
+                                                samples_after, dtype=np.float64, gain=gain)
+                kmeans.partial_fit(pca.transform(snippets))
+
+        labels = np.empty(len(indices), dtype=np.intp)
+        for start, snippets in iter_snippets(voltage, indices, samples_before,
+                                             samples_after, batch_size, gain):
+            labels[start:start + len(snippets)] = kmeans.predict(pca.transform(snippets))
+    run.count('spikes sorted', len(indices))
+
+    # number the units from the largest down
+    sizes = np.bincount(labels, minlength=n_units)
+    ranking = np.argsort(-sizes, kind='mergesort')
+    kmeans.centers = kmeans.centers[ranking]
+    kmeans.counts = kmeans.counts[ranking]
+    labels = np.argsort(ranking)[labels]
+    units = OrderedDict((unit, APTimes[labels == unit]) for unit in range(n_units))
+    return Sorting(units, labels, pca, kmeans)
@@ -0,0 +1,136 @@
+#
+#  NAME
+#    spiketrain.py
+#
+#  DESCRIPTION
+#    SpikeTrain: detected spikes as sorted sample indices with their times
+#    and optional per-spike amplitude and polarity.  It behaves like the
+#    list of spike times the detectors used to return (len, iteration,
+#    indexing, np.asarray) and answers time queries by binary search, for a
+#    single time or a whole array of them at once.
+#
+
+import numpy as np
+
+from recording import time_index
+
+class SpikeTrain(object):
+    """
+    Sorted spikes of one recording.
+        indices - sample index of each spike
+        time - the recording's Timebase or time vector, used to look up
+            each spike's time
+        amplitudes - optional voltage at each spike
+        polarity - optional sign (+1 / -1) of each spike
+    """
+
+    def __init__(self, indices, time, amplitudes=None, polarity=None):
+        indices = np.asarray(indices, dtype=np.intp).ravel()
+        self._set(indices, time[indices] if len(indices) else np.array([]),
+                  amplitudes, polarity)
+
+    @classmethod
+    def from_columns(cls, indices, times, amplitudes=None, polarity=None):
+        """Returns a SpikeTrain of spikes whose times are already known"""
+        train = cls.__new__(cls)
+        train._set(np.asarray(indices, dtype=np.intp).ravel(),
+                   np.asarray(times, dtype=np.float64).ravel(), amplitudes, polarity)
+        return train
+
+    @classmethod
+    def from_times(cls, APTimes, time):
+        """Returns the SpikeTrain of spike times in the recording with time axis time"""
+        APTimes = np.asarray(APTimes, dtype=np.float64)
+        return cls.from_columns(time_index(time, APTimes), APTimes)
+
+    def _set(self, indices, times, amplitudes, polarity):
+        order = None
+        if len(indices) > 1 and (np.diff(indices) < 0).any():
+            order = np.argsort(indices, kind='mergesort')
+        columns = []
+        for column in (indices, times, amplitudes, polarity):
+            if column is not None:
+                column = np.asarray(column).ravel()
+                if len(column) != len(indices):
+                    raise ValueError('every column needs %d values, got %d'
+                                     % (len(indices), len(column)))
+                if order is not None:
+                    column = column[order]
+            columns.append(column)
+        self.indices, self.times, self.amplitudes, self.polarity = columns
+        self.times = np.asarray(self.times, dtype=np.float64)
+
+    def _subset(self, key):
+        pick = lambda column: None if column is None else column[key]
+        return SpikeTrain.from_columns(self.indices[key], self.times[key],
+                                       pick(self.amplitudes), pick(self.polarity))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        return iter(self.times)
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.times, dtype=dtype)
+
+    def __getitem__(self, key):
+        """An integer gives that spike's time; slices and index arrays give a SpikeTrain"""
+        if np.ndim(key) == 0 and not isinstance(key, slice):
+            return self.times[key]
+        return self._subset(key)
+
+    def __repr__(self):
+        return 'SpikeTrain(%d spikes%s)' % (
+            len(self), ', %g-%g s' % (self.times[0], self.times[-1]) if len(self) else '')
+
+    def first_after(self, t, default=0.0):
+        """
+        Returns the time of the first spike strictly after each time in t,
+        or default where there is none
+        """
+        if len(self) == 0:
+            return np.full(np.shape(t), default)[()]
+        position = np.searchsorted(self.times, t, 'right')
+        return np.where(position < len(self),
+                        self.times[np.minimum(position, len(self) - 1)], default)[()]
+
+    def count_in_range(self, start, stop):
+        """Returns the number of spikes with start <= time < stop (start, stop may be arrays)"""
+        return (np.searchsorted(self.times, stop, 'left') -
+                np.searchsorted(self.times, start, 'left'))[()]
+
+    def between(self, start, stop):
+        """Returns the SpikeTrain of spikes with start <= time < stop"""
+        low, high = np.searchsorted(self.times, [start, stop], 'left')
+        return self._subset(slice(low, high))
+
+    def intervals(self):
+        """Returns the inter-spike intervals in seconds"""
+        return np.diff(self.times)
+
+    def save(self, f):
+        """Writes the spike train's columns to an .npz file"""
+        columns = {'indices': self.indices, 'times': self.times}
+        if self.amplitudes is not None:
+            columns['amplitudes'] = self.amplitudes
+        if self.polarity is not None:
+            columns['polarity'] = self.polarity
+        np.savez(f, **columns)
+
+    @classmethod
+    def load(cls, f):
+        """Reads a spike train written by save"""
+        columns = np.load(f)
+        try:
+            return cls.from_columns(columns['indices'], columns['times'],
+                                    columns['amplitudes'] if 'amplitudes' in columns else None,
+                                    columns['polarity'] if 'polarity' in columns else None)
+        finally:
+            columns.close()
+
+def spike_indices(time, APTimes):
+    """Returns the sample index of each spike in APTimes (a SpikeTrain or times)"""
+    if isinstance(APTimes, SpikeTrain):
+        return APTimes.indices
+    return time_index(time, APTimes)
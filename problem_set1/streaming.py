@@ -0,0 +1,182 @@
+#
+#  NAME
+#    streaming.py
+#
+#  DESCRIPTION
+#    Block-by-block spike detection for recordings that do not fit in memory.
+#    The voltage can be any sliceable array (a numpy.memmap works well); only
+#    one block plus a small overlap is held in memory at a time, and the
+#    result is identical to good_AP_finder on the whole array: even the
+#    standard deviation is put together from the same blocks as
+#    voltage_std's, whose moments (three floats per STD_BLOCK samples) are
+#    kept until the end of the first pass.  Blocks are processed in the
+#    voltage's own type, so int16 recordings are read and scanned as counts.
+#
+
+import numpy as np
+
+import filtering
+import instrument
+from problem_set1 import AP_constants, record_AP_constants, find_steep_runs, \
+    refine_peaks, magnitude, detection_input, block_moments, moments_std, STD_BLOCK, \
+    THRESHOLD_RATIO, SLOPE_RATIO, SPREAD_TIME
+from spiketrain import SpikeTrain
+
+# samples per block (8 MB of float64)
+BLOCK_SIZE = 1 << 20
+
+def iter_blocks(n, block_size=BLOCK_SIZE):
+    """
+    Yields (start, stop) index pairs that cover range(n) in order, each at
+    most block_size samples long
+    """
+    if block_size <= 0:
+        raise ValueError('block_size must be positive, got %r' % (block_size,))
+    for start in range(0, n, block_size):
+        yield start, min(start + block_size, n)
+
+class RunningStats(object):
+    """
+    Max, min, mean and standard deviation of a sequence of blocks, updated
+    one block at a time.  Block means and squared deviations are combined
+    pairwise (Chan et al.), so std matches np.std of the whole sequence to
+    rounding.  online.py keeps one, since it cannot hold every block's
+    moments; stream_stats uses voltage_std's blocks instead.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.M2 = 0.0
+        self.max = -np.inf
+        self.min = np.inf
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        if len(block) == 0:
+            return
+        self.max = max(self.max, block.max())
+        self.min = min(self.min, block.min())
+        block_mean = block.mean()
+        block_M2 = np.dot(block - block_mean, block - block_mean)
+        total = self.count + len(block)
+        delta = block_mean - self.mean
+        self.mean += delta * len(block) / total
+        self.M2 += block_M2 + delta * delta * self.count * len(block) / total
+        self.count = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.M2 / self.count) if self.count else 0.0
+
+def stream_stats(voltage, block_size=BLOCK_SIZE):
+    """
+    Returns (max, min, std) of voltage, reading one block (rounded to whole
+    STD_BLOCKs) at a time; std is exactly problem_set1.voltage_std's
+    """
+    block_size = max(STD_BLOCK, block_size - block_size % STD_BLOCK)
+    high, low = -np.inf, np.inf
+    moments = []
+    for start, stop in iter_blocks(len(voltage), block_size):
+        block = np.asarray(voltage[start:stop])
+        high, low = max(high, float(block.max())), min(low, float(block.min()))
+        moments.append(block_moments(block))
+    if not moments:
+        raise ValueError('cannot compute statistics of an empty recording')
+    return high, low, moments_std(*[np.concatenate(column) for column in zip(*moments)])
+
+def stream_AP_indices(voltage, THRESHOLD, AP_SLOPE, SPREAD, block_size=BLOCK_SIZE):
+    """
+    Yields sorted arrays of action potential sample indices, block by block.
+    Concatenated, the arrays equal AP_indices(voltage, ...) on the whole
+    recording: a slope run is handled by the block it starts in, each block
+    is read with enough overlap for its peak windows, and peaks that a later
+    block could still report are held back until it has been read.
+    """
+    n = len(voltage)
+    run = instrument.current()
+    pending = np.array([], dtype=np.intp)
+    for start, stop in iter_blocks(n, block_size):
+        # a run starting at i needs voltage[i:i+4] and the peak window
+        # around i+2, clipped to the recording
+        seg_start = max(0, min(start, start + 2 - SPREAD))
+        seg_stop = min(n, stop + 3 + SPREAD)
+        segment = np.asarray(voltage[seg_start:seg_stop])
+
+        runs = find_steep_runs(segment, AP_SLOPE)
+        runs = runs[runs + seg_start < stop]
+        runs = runs[runs + seg_start >= start]
+        peaks = refine_peaks(segment, runs + 2, SPREAD)
+        with run.stage('dedup'):
+            peaks = peaks[magnitude(segment[peaks]) > THRESHOLD] + seg_start
+            pending = np.union1d(pending, peaks)
+            # later runs start at stop or after, so their peaks are >= this
+            settled = np.searchsorted(pending, stop + 2 - SPREAD)
+        if settled:
+            run.count('spikes accepted', settled)
+            yield pending[:settled]
+            pending = pending[settled:]
+    if len(pending):
+        run.count('spikes accepted', len(pending))
+        yield pending
+
+def stream_AP_finder(time, voltage, block_size=BLOCK_SIZE,
+                     threshold_ratio=THRESHOLD_RATIO, slope_ratio=SLOPE_RATIO,
+                     spread_time=SPREAD_TIME, band=None, verbose=False, gain=None,
+                     stats=None):
+    """
+    This function takes the following input:
+        time - vector where each element is a time in seconds, or a Timebase
+        voltage - vector where each element is a voltage at a different time
+        block_size - number of samples to read at a time
+        threshold_ratio, slope_ratio, spread_time - detector tuning (see
+            problem_set1.AP_constants)
+        band - optional (low, high) Hz to bandpass filter the voltage to,
+            block by block, before detecting (see filtering.BandpassView)
+        verbose - print the detection constants and spike count
+        gain - voltage per count, when voltage is integer ADC counts
+        stats - optional (max, min, std) of voltage to use instead of a
+            first pass over it (see pyramid.py); ignored when band is given
+
+        time and voltage may be memory-mapped; only the spike times are
+        read from time and only block_size (plus overlap) samples of
+        voltage are resident at once.
+
+    This function returns the following output:
+        APTimes - SpikeTrain of the detected spikes (the same as
+            good_AP_finder)
+    """
+    if (len(voltage) != len(time)):
+        print "Can't run - the vectors aren't the same length!"
+        return []
+
+    voltage, gain, stats = detection_input(voltage, gain, stats)
+    run = instrument.current()
+    run.count('samples processed', len(voltage))
+    SAMPLING_RATE = time[1]-time[0]
+    if band is not None:
+        voltage = filtering.BandpassView(voltage, 1.0 / SAMPLING_RATE, *band)
+    with run.stage('stats'):
+        if stats is not None and band is None:
+            max_voltage, min_voltage, std_voltage = stats
+        else:
+            max_voltage, min_voltage, std_voltage = stream_stats(voltage, block_size)
+    THRESHOLD, AP_SLOPE, SPREAD = AP_constants(SAMPLING_RATE, max_voltage,
+                                               min_voltage, std_voltage,
+                                               threshold_ratio, slope_ratio,
+                                               spread_time)
+    record_AP_constants(THRESHOLD, SAMPLING_RATE, AP_SLOPE, SPREAD, verbose)
+
+    indices = list(stream_AP_indices(voltage, THRESHOLD, AP_SLOPE, SPREAD, block_size))
+    indices = np.concatenate(indices) if indices else np.array([], dtype=np.intp)
+    if isinstance(voltage, np.ndarray):
+        # only touches the pages the spikes are on
+        amplitudes = np.asarray(voltage[indices], dtype=np.float64) * (1.0 if gain is None else gain)
+        APTimes = SpikeTrain(indices, time, amplitudes, np.sign(amplitudes))
+    else:
+        APTimes = SpikeTrain(indices, time)
+
+    if verbose:
+        print '# APs found: %d' % len(APTimes)
+
+    return APTimes
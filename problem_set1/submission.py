@@ -0,0 +1,218 @@
+#
+#  NAME
+#    submission.py
+#
+#  DESCRIPTION
+#    Client for the challenge/submit protocol of problem_set1_submit.py.
+#    Every part needs two requests (getChallenge, then submitSolution);
+#    here parts run concurrently on a bounded number of threads, requests
+#    to a host share a pool of keep-alive connections, and each request has
+#    a timeout.  A challenge is single-use, so on a transient failure
+#    (connection error, timeout, 5xx or 429 response) of either request the
+#    whole part is retried with exponential backoff, from a new challenge.
+#
+#    submit_server.py is a stand-in server for trying it out locally.
+#
+
+import hashlib
+import httplib
+import random
+import socket
+import threading
+import time as wallclock
+import urllib
+import urlparse
+import email.message
+import email.encoders
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+WORKERS = 4
+TIMEOUT = 30.0
+RETRIES = 4
+# seconds before the first retry; doubled for each one after
+BACKOFF = 0.5
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+
+class TransientError(Exception):
+    """A request failed in a way that may succeed if tried again"""
+
+class SubmissionError(Exception):
+    """The server answered, but not with what the protocol expects"""
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP(S) connections, reused per (scheme, host, port).  At
+    most max_per_host connections to a host are kept idle; a connection
+    that fails is closed rather than returned.
+    """
+
+    def __init__(self, max_per_host=WORKERS, timeout=TIMEOUT):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def _get(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+            self.opened += 1
+        scheme, host, port = key
+        factory = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return factory(host, port, timeout=self.timeout)
+
+    def _put(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def post(self, url, values):
+        """
+        POSTs the form values to url and returns (status, body).  Raises
+        TransientError if the connection fails or times out.
+        """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        connection = self._get(key)
+        try:
+            connection.request('POST', path, urllib.urlencode(values),
+                               {'Content-Type': 'application/x-www-form-urlencoded',
+                                'Connection': 'keep-alive'})
+            response = connection.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException) as error:
+            connection.close()
+            raise TransientError('%s: %s' % (url, error))
+        if response.will_close:
+            connection.close()
+        else:
+            self._put(key, connection)
+        return response.status, body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+def with_retries(request, retries=RETRIES, backoff=BACKOFF, sleep=wallclock.sleep):
+    """
+    Returns request(), calling it again after backoff, 2 * backoff, ...
+    seconds (with jitter) while it raises TransientError, at most retries
+    more times
+    """
+    for attempt in range(retries + 1):
+        try:
+            return request()
+        except TransientError:
+            if attempt == retries:
+                raise
+            sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+def challenge_response(password, challenge):
+    """Returns the hex SHA-1 of the challenge and password"""
+    return hashlib.sha1(''.join([challenge, password])).hexdigest()
+
+def base64_payload(text):
+    message = email.message.Message()
+    message.set_payload(text)
+    email.encoders.encode_base64(message)
+    return message.get_payload()
+
+Part = namedtuple('Part', ['sid', 'output', 'source'])
+PartResult = namedtuple('PartResult', ['sid', 'ok', 'message'])
+
+class SubmissionClient(object):
+    """
+    Submits assignment parts to the server at base_url (e.g.
+    'https://class.coursera.org/neuraldata-001').
+        workers - parts submitted at once
+        timeout - seconds to wait on any one request
+        retries, backoff - see with_retries
+    """
+
+    def __init__(self, base_url, workers=WORKERS, timeout=TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF):
+        self.base_url = base_url.rstrip('/')
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ConnectionPool(workers, timeout)
+
+    def _post(self, path, values):
+        """
+        POSTs values to path once and returns the response text.  Raises
+        TransientError for failures worth retrying, SubmissionError otherwise.
+        """
+        status, body = self.pool.post(self.base_url + path, values)
+        if status in TRANSIENT_STATUS:
+            raise TransientError('%s: HTTP %d' % (path, status))
+        if status != 200:
+            raise SubmissionError('%s: HTTP %d %s' % (path, status, body.strip()))
+        return body.strip()
+
+    def get_challenge(self, email_address, sid):
+        """Returns (email, challenge, state, challenge aux) for a part"""
+        text = self._post('/assignment/challenge',
+                          {'email_address': email_address, 'assignment_part_sid': sid,
+                           'response_encoding': 'delim'})
+        # text is of the form |email_address|E|challenge_key|C|state|S|challenge_aux_data|A
+        splits = text.split('|')
+        if len(splits) != 9:
+            raise SubmissionError('badly formatted challenge response: %s' % text)
+        return splits[2], splits[4], splits[6], splits[8]
+
+    def submit_solution(self, email_address, ch_resp, sid, output, source, state, ch_aux):
+        """Submits one part's output and returns the server's message"""
+        return self._post('/assignment/submit',
+                          {'assignment_part_sid': sid,
+                           'email_address': email_address,
+                           'submission': base64_payload(output),
+                           'submission_aux': base64_payload(source),
+                           'challenge_response': ch_resp,
+                           'state': state})
+
+    def submit_part(self, login, password, part):
+        """
+        Returns the PartResult of getting a challenge for part and submitting
+        it.  A transient failure of either request starts over with a new
+        challenge; if a failed submit had in fact reached the server, the
+        part is sent again, which the server takes as a resubmission.
+        """
+        def attempt():
+            email_address, ch, state, ch_aux = self.get_challenge(login, part.sid)
+            return self.submit_solution(email_address, challenge_response(password, ch),
+                                        part.sid, part.output, part.source, state, ch_aux)
+        try:
+            message = with_retries(attempt, self.retries, self.backoff)
+            return PartResult(part.sid, True, message)
+        except (TransientError, SubmissionError) as error:
+            return PartResult(part.sid, False, str(error))
+
+    def submit_parts(self, login, password, parts, callback=None):
+        """
+        Submits every Part (outputs already computed) on up to workers
+        threads and returns their PartResults in order.  callback, if given,
+        is called with (index, PartResult) as each part finishes.
+        """
+        def task(index):
+            result = self.submit_part(login, password, parts[index])
+            if callback is not None:
+                callback(index, result)
+            return result
+
+        threads = ThreadPool(max(1, min(self.workers, len(parts))))
+        try:
+            return threads.map(task, range(len(parts)), chunksize=1)
+        finally:
+            threads.close()
+            threads.join()
+            self.pool.close()
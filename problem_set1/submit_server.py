@@ -0,0 +1,164 @@
+#
+#  NAME
+#    submit_server.py
+#
+#  DESCRIPTION
+#    Local stand-in for the course submission server, speaking the same
+#    challenge/submit protocol, for trying out submission.py and
+#    problem_set1_submit.py without touching the real one.  Responses can
+#    be delayed and made to fail at random, to exercise timeouts and
+#    retries: --failure-rate fails requests before they are handled, and
+#    --late-failure-rate fails submissions after their challenge has been
+#    used up and the output recorded, as when a response is lost:
+#        python submit_server.py --port 8000 --latency 0.2 --failure-rate 0.3
+#        SUBMIT_BASE_URL=http://localhost:8000/neuraldata-001 python problem_set1_submit.py
+#    Any login works; the one-time password is 'sandbox' unless --password
+#    is given.
+#
+
+import argparse
+import base64
+import hashlib
+import random
+import sys
+import threading
+import time as wallclock
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+PASSWORD = 'sandbox'
+
+class SubmitHandler(BaseHTTPRequestHandler):
+    # keep-alive, as the real server allows
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _reply(self, status, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.getheader('Content-Length') or 0)
+        form = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        if server.latency:
+            wallclock.sleep(server.latency * random.uniform(0.5, 1.5))
+        with server.lock:
+            server.requests += 1
+        if random.random() < server.failure_rate:
+            with server.lock:
+                server.failures += 1
+            self._reply(503, 'Service Unavailable')
+            return
+
+        if self.path.endswith('/assignment/challenge'):
+            self._challenge(form)
+        elif self.path.endswith('/assignment/submit'):
+            self._submit(form)
+        else:
+            self._reply(404, 'Not Found')
+
+    def _challenge(self, form):
+        server = self.server
+        email = form.get('email_address', '')
+        sid = form.get('assignment_part_sid', '')
+        challenge = '%032x' % random.getrandbits(128)
+        state = '%016x' % random.getrandbits(64)
+        with server.lock:
+            server.challenges[state] = (email, sid, challenge)
+        self._reply(200, '|email_address|%s|challenge_key|%s|state|%s|challenge_aux_data|%s'
+                    % (email, challenge, state, ''))
+
+    def _submit(self, form):
+        server = self.server
+        with server.lock:
+            issued = server.challenges.pop(form.get('state'), None)
+        if issued is None:
+            self._reply(200, 'Your submission was rejected: unknown or reused challenge.')
+            return
+        email, sid, challenge = issued
+        expected = hashlib.sha1(challenge + server.password).hexdigest()
+        if (form.get('email_address'), form.get('assignment_part_sid')) != (email, sid) or \
+                form.get('challenge_response') != expected:
+            self._reply(200, 'Your submission was rejected: wrong login or password.')
+            return
+        output = base64.b64decode(form.get('submission', ''))
+        with server.lock:
+            server.submissions[sid] = output
+            server.received[sid] = server.received.get(sid, 0) + 1
+        if random.random() < server.late_failure_rate:
+            with server.lock:
+                server.failures += 1
+            self._reply(503, 'Service Unavailable')
+            return
+        self._reply(200, 'Received %s for %s (sandbox server, not graded).' % (output.strip(), sid))
+
+class SubmitServer(ThreadingMixIn, HTTPServer):
+    """
+    The stand-in server.  latency is the mean delay of every response in
+    seconds, failure_rate the fraction of requests answered with 503 before
+    they are handled, and late_failure_rate the fraction of accepted
+    submissions answered with 503 all the same.  submissions maps each
+    accepted part sid to its decoded output, and received to the number of
+    times it was accepted.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('localhost', 0), latency=0.0, failure_rate=0.0,
+                 password=PASSWORD, verbose=False, late_failure_rate=0.0):
+        HTTPServer.__init__(self, address, SubmitHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.late_failure_rate = late_failure_rate
+        self.password = password
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.challenges = {}
+        self.submissions = {}
+        self.received = {}
+        self.requests = 0
+        self.failures = 0
+
+    def url(self, course='neuraldata-001'):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d/%s' % (host, port, course)
+
+    def start(self):
+        """Serves on a background thread and returns self"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for the submission server.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds per response')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='fraction of requests answered 503')
+    parser.add_argument('--late-failure-rate', type=float, default=0.0,
+                        help='fraction of accepted submissions answered 503')
+    parser.add_argument('--password', default=PASSWORD)
+    args = parser.parse_args(argv)
+
+    server = SubmitServer((args.host, args.port), args.latency, args.failure_rate,
+                          args.password, verbose=True,
+                          late_failure_rate=args.late_failure_rate)
+    print 'Serving on %s' % server.url()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
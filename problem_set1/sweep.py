@@ -0,0 +1,231 @@
+#
+#  NAME
+#    sweep.py
+#
+#  DESCRIPTION
+#    Parameter sweep for the good_AP_finder tuning (threshold_ratio,
+#    slope_ratio, spread_time).  Every parameter set is run on every dataset
+#    and scored like detector_tester, across a pool of worker processes, and
+#    the results come back ranked.
+#
+#    Recordings are loaded once in the parent before the pool starts, so the
+#    forked workers read the same pages instead of receiving pickled copies
+#    (.rec files are memory-mapped and shared through the page cache either
+#    way).  Each worker builds a candidate table (see candidates.py) per
+#    dataset and spread_time the first time it needs one, so most parameter
+#    sets only re-threshold a table.  From the command line:
+#        python sweep.py -d spikes_easy_practice.npy spikes_easy_practice_answers.npy \
+#            --threshold-ratio 0.3 0.4 0.5 --slope-ratio 1.5 2 2.5 3
+#        python sweep.py -d ... --random 500 --threshold-ratio 0.2 0.6
+#
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import sys
+
+import numpy as np
+
+from candidates import CandidateTable
+from problem_set1 import load_data, get_actual_times, AP_constants, score_detector, \
+    voltage_std, THRESHOLD_RATIO, SLOPE_RATIO, SPREAD_TIME
+
+PARAMETERS = ('threshold_ratio', 'slope_ratio', 'spread_time')
+DEFAULTS = {'threshold_ratio': THRESHOLD_RATIO,
+            'slope_ratio': SLOPE_RATIO,
+            'spread_time': SPREAD_TIME}
+# detector_tester's pass criteria
+PASS_TRUE_SPIKES = 90.0
+PASS_FALSE_RATE = 2.5
+
+# recording file -> (time, voltage, gain, (max, min, std), actualTimes)
+_datasets = {}
+# (recording file, SPREAD) -> CandidateTable, built in each process as needed
+_tables = {}
+
+def parameter_grid(**values):
+    """
+    Returns a list of parameter dicts, one for every combination of the
+    given values; parameters that are not given keep their defaults
+    """
+    names = [name for name in PARAMETERS if name in values]
+    grid = []
+    for combination in itertools.product(*[values[name] for name in names]):
+        params = dict(DEFAULTS)
+        params.update(zip(names, combination))
+        grid.append(params)
+    return grid
+
+def random_parameters(count, seed=None, **ranges):
+    """
+    Returns count parameter dicts drawn uniformly from the (low, high)
+    ranges given; parameters that are not given keep their defaults
+    """
+    rng = np.random.RandomState(seed)
+    draws = []
+    for i in range(count):
+        params = dict(DEFAULTS)
+        for name in PARAMETERS:
+            if name in ranges:
+                low, high = ranges[name]
+                params[name] = rng.uniform(low, high)
+        draws.append(params)
+    return draws
+
+def load_datasets(datasets):
+    """
+    Loads each (recording file, answers file) pair into this process,
+    along with the voltage statistics every parameter set shares
+    """
+    for recording_file, answers_file in datasets:
+        if recording_file not in _datasets:
+            # the samples as stored (a memmap of counts for .rec files), and
+            # their gain for the detectors
+            time, voltage, gain = load_data(recording_file, counts=True)
+            stats = (float(voltage.max()), float(voltage.min()), voltage_std(voltage))
+            _datasets[recording_file] = (time, voltage, gain, stats,
+                                         get_actual_times(answers_file))
+
+def candidate_table(recording_file, SPREAD, spread_time, min_slope_ratio):
+    """
+    Returns the candidate table of a loaded dataset for SPREAD, building it
+    (again) if there is none yet that goes down to min_slope_ratio
+    """
+    table = _tables.get((recording_file, SPREAD))
+    if table is None or table.min_slope_ratio > min_slope_ratio:
+        time, voltage, gain, stats, actualTimes = _datasets[recording_file]
+        table = CandidateTable.build(time, voltage, spread_time, min_slope_ratio, gain=gain,
+                                     stats=stats)
+        _tables[(recording_file, SPREAD)] = table
+    return table
+
+def evaluate(params, datasets, min_slope_ratio=None):
+    """
+    Returns the score_detector dict of params on each loaded dataset.
+    Candidate tables are built for slope ratios down to min_slope_ratio
+    (by default params' own), so that later parameter sets can reuse them.
+    """
+    if min_slope_ratio is None:
+        min_slope_ratio = params['slope_ratio']
+    scores = []
+    for recording_file, answers_file in datasets:
+        time, voltage, gain, stats, actualTimes = _datasets[recording_file]
+        THRESHOLD, AP_SLOPE, SPREAD = AP_constants(time[1]-time[0], *stats, **params)
+        table = candidate_table(recording_file, SPREAD, params['spread_time'],
+                                min(min_slope_ratio, params['slope_ratio']))
+        APTimes = time[table.select(THRESHOLD, AP_SLOPE)]
+        scores.append(score_detector(APTimes, actualTimes))
+    return scores
+
+def _evaluate_task(task):
+    index, params, datasets, min_slope_ratio = task
+    return index, evaluate(params, datasets, min_slope_ratio)
+
+def passes(row):
+    return (row['Percent True Spikes'] > PASS_TRUE_SPIKES and
+            row['False Spike Rate'] < PASS_FALSE_RATE)
+
+def rank_key(row):
+    """Passing rows first, then most true spikes, then fewest extra spikes"""
+    return (not passes(row), -row['Percent True Spikes'], abs(row['False Spike Rate']))
+
+def sweep(datasets, parameter_sets, processes=None):
+    """
+    This function takes the following input:
+        datasets - list of (recording file, answers file) pairs
+        parameter_sets - list of parameter dicts (see parameter_grid and
+            random_parameters)
+        processes - worker processes (default one per core; 1 runs in
+            this process)
+
+    This function returns the following output:
+        rows - one dict per parameter set, best first, holding the
+            parameters, the mean 'Percent True Spikes' and 'False Spike Rate'
+            over the datasets and the per-dataset 'Scores'
+    """
+    datasets = [tuple(pair) for pair in datasets]
+    load_datasets(datasets)
+    min_slope_ratio = min(params['slope_ratio'] for params in parameter_sets)
+    # sets sharing a spread_time share candidate tables, so keep them together
+    order = sorted(range(len(parameter_sets)),
+                   key=lambda i: (parameter_sets[i]['spread_time'], i))
+    tasks = [(i, parameter_sets[i], datasets, min_slope_ratio) for i in order]
+
+    if processes == 1:
+        results = [_evaluate_task(task) for task in tasks]
+    else:
+        # workers forked from here inherit the loaded recordings; the
+        # initializer only loads anything where processes are spawned
+        pool = multiprocessing.Pool(processes, load_datasets, (datasets,))
+        try:
+            chunksize = max(1, len(tasks) // (4 * (processes or multiprocessing.cpu_count())))
+            results = list(pool.imap_unordered(_evaluate_task, tasks, chunksize))
+        finally:
+            pool.close()
+            pool.join()
+
+    rows = []
+    for index, scores in results:
+        row = dict(parameter_sets[index])
+        row['Percent True Spikes'] = np.mean([score['Percent True Spikes'] for score in scores])
+        row['False Spike Rate'] = np.mean([score['False Spike Rate'] for score in scores])
+        row['Scores'] = scores
+        rows.append(row)
+    rows.sort(key=rank_key)
+    return rows
+
+def format_table(rows, top=None):
+    """Returns the ranked rows as a text table"""
+    lines = ['%4s  %15s  %11s  %11s  %12s  %15s  %s'
+             % ('rank', 'threshold_ratio', 'slope_ratio', 'spread_time',
+                '% true', 'false spikes/s', 'eval')]
+    for rank, row in enumerate(rows[:top], 1):
+        lines.append('%4d  %15.4f  %11.4f  %11.6f  %12.3f  %15.3f  %s'
+                     % (rank, row['threshold_ratio'], row['slope_ratio'],
+                        row['spread_time'], row['Percent True Spikes'],
+                        row['False Spike Rate'], 'PASS' if passes(row) else 'FAIL'))
+    return '\n'.join(lines)
+
+def write_csv(rows, filename):
+    """Writes the ranked rows (without per-dataset scores) to a CSV file"""
+    fields = list(PARAMETERS) + ['Percent True Spikes', 'False Spike Rate']
+    with open(filename, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank'] + fields)
+        for rank, row in enumerate(rows, 1):
+            writer.writerow([rank] + [row[field] for field in fields])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep good_AP_finder tuning over recordings with answers.')
+    parser.add_argument('-d', '--data', nargs=2, action='append', required=True,
+                        metavar=('RECORDING', 'ANSWERS'),
+                        help='recording file and its answers file (repeatable)')
+    for name in PARAMETERS:
+        parser.add_argument('--' + name.replace('_', '-'), nargs='+', type=float,
+                            dest=name, help='values to try (grid) or LOW HIGH (with --random)')
+    parser.add_argument('--random', type=int, metavar='N',
+                        help='draw N random parameter sets instead of a grid')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('-p', '--processes', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--top', type=int, default=20, help='rows to print')
+    parser.add_argument('--csv', help='write all ranked rows to this file')
+    args = parser.parse_args(argv)
+
+    given = dict((name, getattr(args, name)) for name in PARAMETERS
+                 if getattr(args, name) is not None)
+    if args.random:
+        for name, values in given.items():
+            if len(values) != 2:
+                parser.error('--%s takes LOW HIGH with --random' % name.replace('_', '-'))
+        parameter_sets = random_parameters(args.random, args.seed, **given)
+    else:
+        parameter_sets = parameter_grid(**given)
+
+    rows = sweep(args.data, parameter_sets, args.processes)
+    print format_table(rows, args.top)
+    if args.csv:
+        write_csv(rows, args.csv)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
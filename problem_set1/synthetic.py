@@ -0,0 +1,171 @@
+#
+#  NAME
+#    synthetic.py
+#
+#  DESCRIPTION
+#    Synthetic extracellular recordings with exact ground truth: white
+#    noise, optional slow drift, and spikes from a set of waveform shapes at
+#    Poisson times with a refractory period.  Recordings can be built in
+#    memory or written block by block straight to a recording file, so hours
+#    of data never have to fit in memory.
+#
+
+import numpy as np
+
+import recording
+from recording import Timebase
+
+# samples generated per block when writing a file
+BLOCK_SIZE = 1 << 20
+# noise is drawn in fixed chunks, each from its own seed, so any block of
+# the recording comes out the same however the blocks are cut
+NOISE_CHUNK = 1 << 16
+
+# (time in ms, relative amplitude) corners of the default waveform shapes,
+# each with a sharp negative peak at 0.1 ms
+SHAPES = [
+    [(0.0, 0.0), (0.1, -1.0), (0.3, 0.4), (0.8, 0.1), (1.5, 0.0)],
+    [(0.0, 0.0), (0.1, -1.0), (0.2, 0.1), (0.5, 0.35), (1.5, 0.0)],
+    [(0.0, 0.0), (0.05, -0.3), (0.1, -1.0), (0.25, 0.6), (1.0, 0.0)],
+]
+
+def shape_templates(sample_rate, shapes=SHAPES):
+    """
+    Returns a list of (template, peak) pairs: each shape sampled at
+    sample_rate, and the index of its largest excursion
+    """
+    templates = []
+    for corners in shapes:
+        ms, amplitude = np.transpose(corners)
+        samples = np.arange(int(np.ceil(ms[-1] / 1000.0 * sample_rate)) + 1)
+        template = np.interp(samples * 1000.0 / sample_rate, ms, amplitude)
+        templates.append((template, int(np.abs(template).argmax())))
+    return templates
+
+def spike_train(duration, spike_rate, refractory, rng):
+    """Returns sorted Poisson spike onset times with a refractory period"""
+    if spike_rate <= 0:
+        return np.array([])
+    mean_interval = max(1.0 / spike_rate - refractory, 1e-9)
+    expected = int(duration * spike_rate * 1.2) + 10
+    onsets = np.cumsum(refractory + rng.exponential(mean_interval, expected))
+    while onsets[-1] < duration:
+        more = np.cumsum(refractory + rng.exponential(mean_interval, expected))
+        onsets = np.append(onsets, onsets[-1] + more)
+    return onsets[onsets < duration]
+
+class SyntheticRecording(object):
+    """
+    Description of a synthetic recording.
+        duration - seconds
+        sample_rate - samples per second
+        noise - standard deviation of the white noise (uV)
+        spike_rate - mean spikes per second per channel
+        amplitude - (low, high) range of spike peak amplitudes (uV)
+        shapes - waveform corner lists (see SHAPES); each spike picks one
+        n_channels - independent channels
+        drift - amplitude of a slow 1-8 Hz drift (uV)
+        refractory - minimum seconds between spikes on a channel
+        seed - random seed; the same seed gives the same recording
+        dtype - sample type; integer types give ADC counts with a gain
+            (uV per count) that covers the largest spike plus noise
+
+    Ground truth (spike sample indices, shapes and amplitudes) is drawn up
+    front; samples are generated block by block on request.
+    """
+
+    def __init__(self, duration=10.0, sample_rate=30000.0, noise=10.0, spike_rate=20.0,
+                 amplitude=(120.0, 200.0), shapes=SHAPES, n_channels=1, drift=0.0,
+                 refractory=.003, seed=None, dtype=np.float64):
+        self.timebase = Timebase(0.0, 1.0 / sample_rate, int(round(duration * sample_rate)))
+        self.noise = noise
+        self.drift = drift
+        self.dtype = np.dtype(dtype)
+        self.gain = None
+        if self.dtype.kind in 'iu':
+            self.gain = (max(amplitude) + drift + 6 * noise) / np.iinfo(self.dtype).max
+        self.n_channels = n_channels
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.templates = shape_templates(sample_rate, shapes)
+
+        rng = np.random.RandomState(self.seed)
+        self.drift_hz = rng.uniform(1.0, 8.0, n_channels)
+        self.drift_phase = rng.uniform(0, 2 * np.pi, n_channels)
+        longest = max(len(template) for template, peak in self.templates)
+        # onset sample, shape and amplitude of each spike, per channel
+        self.spikes = []
+        for channel in range(n_channels):
+            onsets = self.timebase.index(spike_train(duration, spike_rate, refractory, rng))
+            onsets = np.unique(onsets[onsets + longest < len(self.timebase)])
+            self.spikes.append((onsets,
+                                rng.randint(len(self.templates), size=len(onsets)),
+                                rng.uniform(amplitude[0], amplitude[1], len(onsets))))
+
+    def __len__(self):
+        return len(self.timebase)
+
+    def spike_indices(self, channel=0):
+        """Returns the sample index of each spike's peak on channel"""
+        onsets, shapes, amplitudes = self.spikes[channel]
+        peaks = np.array([peak for template, peak in self.templates], dtype=np.intp)
+        return onsets + peaks[shapes]
+
+    def spike_times(self, channel=0):
+        """Returns the exact ground-truth spike (peak) times on channel"""
+        return self.timebase[self.spike_indices(channel)]
+
+    def block(self, start, stop):
+        """Returns samples [start, stop) of every channel (channels x samples)"""
+        n = stop - start
+        voltage = np.empty((self.n_channels, n))
+        for chunk in range(start // NOISE_CHUNK, (stop - 1) // NOISE_CHUNK + 1):
+            rng = np.random.RandomState([self.seed, chunk])
+            noise = rng.normal(0.0, self.noise, (self.n_channels, NOISE_CHUNK))
+            low = max(start, chunk * NOISE_CHUNK)
+            high = min(stop, (chunk + 1) * NOISE_CHUNK)
+            voltage[:, low - start:high - start] = noise[:, low - chunk * NOISE_CHUNK:
+                                                         high - chunk * NOISE_CHUNK]
+        if self.drift:
+            t = self.timebase.times(np.arange(start, stop))
+            voltage += self.drift * np.sin(2 * np.pi * self.drift_hz[:, np.newaxis] * t +
+                                           self.drift_phase[:, np.newaxis])
+        for channel, (onsets, shapes, amplitudes) in enumerate(self.spikes):
+            for shape, (template, peak) in enumerate(self.templates):
+                # spikes of this shape that overlap the block
+                chosen = shapes == shape
+                begin = np.searchsorted(onsets, start - len(template) + 1)
+                end = np.searchsorted(onsets, stop)
+                which = np.flatnonzero(chosen[begin:end]) + begin
+                if len(which) == 0:
+                    continue
+                positions = onsets[which, np.newaxis] - start + np.arange(len(template))
+                values = amplitudes[which, np.newaxis] * template
+                inside = (positions >= 0) & (positions < n)
+                np.add.at(voltage[channel], positions[inside], values[inside])
+        if self.gain is not None:
+            return recording.to_counts(voltage, self.gain, self.dtype)
+        return voltage.astype(self.dtype)
+
+    def voltage(self):
+        """Returns the whole recording in memory (a vector for one channel)"""
+        voltage = self.block(0, len(self))
+        return voltage[0] if self.n_channels == 1 else voltage
+
+    def write(self, filename, block_size=BLOCK_SIZE):
+        """Writes the recording to a recording file one block at a time"""
+        with recording.RecordingWriter(filename, self.n_channels, len(self),
+                                       self.timebase.sample_rate, self.timebase.t0,
+                                       self.dtype, gain=self.gain) as writer:
+            for start in range(0, len(self), block_size):
+                writer.write(start, self.block(start, min(start + block_size, len(self))))
+        return filename
+
+def make_recording(**settings):
+    """
+    Returns (time, voltage, spike_times) for a SyntheticRecording built from
+    settings, with spike_times a list per channel when there are several
+    """
+    synthetic = SyntheticRecording(**settings)
+    spike_times = [synthetic.spike_times(channel) for channel in range(synthetic.n_channels)]
+    return (synthetic.timebase, synthetic.voltage(),
+            spike_times[0] if synthetic.n_channels == 1 else spike_times)
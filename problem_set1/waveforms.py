@@ -0,0 +1,103 @@
+#
+#  NAME
+#    waveforms.py
+#
+#  DESCRIPTION
+#    Waveform snippets around detected spikes.  All snippets are gathered
+#    in one indexing operation into an (n_spikes x window) matrix, through a
+#    zero-copy sliding-window view of the voltage when every window lies
+#    inside the recording.  Windows that run off either end are padded,
+#    dropped or clipped, as asked.  Integer counts (or a ScaledView of them
+#    from load_data) are gathered as they are and only the snippets scaled
+#    to voltage, so the recording is never converted as a whole.
+#
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from recording import time_index
+
+EDGES = ('pad', 'drop', 'clip')
+
+def sliding_windows(voltage, width):
+    """
+    Returns a read-only (len(voltage) - width + 1) x width view of voltage
+    whose row i is voltage[i:i+width], without copying any samples
+    """
+    voltage = np.asanyarray(voltage)
+    if voltage.ndim != 1 or len(voltage) < width:
+        raise ValueError('need a vector of at least %d samples, got shape %r'
+                         % (width, voltage.shape))
+    stride = voltage.strides[0]
+    return as_strided(voltage, shape=(len(voltage) - width + 1, width),
+                      strides=(stride, stride), writeable=False)
+
+def extract_waveforms(voltage, indices, before, after, edge='pad', dtype=None, fill=0.0,
+                      gain=None):
+    """
+    This function takes the following input:
+        voltage - vector of samples (may be a memmap, or a ScaledView from
+            load_data)
+        indices - sample index of each spike
+        before, after - samples to take before the spike and from it on;
+            each snippet is voltage[index-before:index+after]
+        edge - what to do with windows that run off the recording:
+            'pad' fills the missing samples with fill, 'drop' leaves those
+            spikes out, and 'clip' repeats the first or last sample
+        dtype - dtype of the result (e.g. np.float32; default voltage's,
+            or float32 when the snippets are scaled by gain)
+        fill - value of the padding, in the units of the result
+        gain - voltage per count, when voltage is integer ADC counts; the
+            snippets are scaled by it like a ScaledView
+
+    This function returns the following output:
+        waveforms - len(indices) x (before + after) matrix, one row per spike
+        indices - the spike indices the rows belong to (fewer than given
+            when edge is 'drop')
+    """
+    if edge not in EDGES:
+        raise ValueError('edge must be one of %s, got %r' % (EDGES, edge))
+    # imported here, since problem_set1 imports this module
+    from problem_set1 import detection_input
+    voltage, gain, _ = detection_input(voltage, gain)
+    voltage = np.asanyarray(voltage)
+    indices = np.asarray(indices, dtype=np.intp).ravel()
+    width = before + after
+    starts = indices - before
+    inside = (starts >= 0) & (starts + width <= len(voltage))
+    if edge == 'drop':
+        indices = indices[inside]
+        starts = starts[inside]
+        inside = inside[inside]
+
+    waveforms = np.empty((len(starts), width),
+                         dtype=voltage.dtype if gain is not None else dtype or voltage.dtype)
+    if inside.any():
+        waveforms[inside] = sliding_windows(voltage, width)[starts[inside]]
+    if not inside.all():
+        # only the few windows at the ends need per-sample edge handling
+        positions = starts[~inside, np.newaxis] + np.arange(width)
+        waveforms[~inside] = voltage[np.clip(positions, 0, len(voltage) - 1)]
+    if gain is not None:
+        # the same float32 product as ScaledView, for the gathered rows only
+        waveforms = np.multiply(waveforms, np.float32(gain), dtype=np.float32)
+        waveforms = waveforms.astype(dtype or np.float32, copy=False)
+    if edge == 'pad' and not inside.all():
+        outside = waveforms[~inside]
+        outside[(positions < 0) | (positions >= len(voltage))] = fill
+        waveforms[~inside] = outside
+    return waveforms, indices
+
+def spike_waveforms(time, voltage, APTimes, before=.003, after=.003, edge='pad', dtype=None):
+    """
+    Returns (xaxis, waveforms, indices): the snippets from before seconds
+    ahead of to after seconds past each spike time (see extract_waveforms),
+    with xaxis holding each column's time relative to the spike
+    """
+    SAMPLING_RATE = time[1]-time[0]
+    samples_before = int(round(before / SAMPLING_RATE))
+    samples_after = int(round(after / SAMPLING_RATE))
+    waveforms, indices = extract_waveforms(voltage, time_index(time, APTimes),
+                                           samples_before, samples_after, edge, dtype)
+    xaxis = np.arange(-samples_before, samples_after) * SAMPLING_RATE
+    return xaxis, waveforms, indices